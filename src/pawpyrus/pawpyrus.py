@@ -1,40 +1,63 @@
 __version__ = '2022.8.7.3'
 __repository__ = 'https://github.com/regnveig/pawpyrus'
 
-from more_itertools import sliced #
+from more_itertools import chunked #
 from pyzbar.pyzbar import decode #
 from qrcode import * #
-from reportlab.graphics import renderPDF #
+from qrcode.exceptions import DataOverflowError #
+from qrcode.util import QRData, MODE_ALPHA_NUM #
 from reportlab.lib.units import mm #
 from reportlab.pdfgen import canvas #
-from svglib.svglib import svg2rlg #
+from reportlab.pdfgen.pathobject import PDFPathObject #
 import argparse
+import asyncio
 import base64
 import binascii
-import bitarray #
+import bz2
+import concurrent.futures
+import contextlib
 import cv2 # opencv-python + opencv-contrib-python
 import datetime
+import functools
 import hashlib
 import io
 import itertools
 import json
 import logging
+import lzma
 import math
+import multiprocessing
 import numpy #
 import os
 import secrets
+import sqlite3
+import struct
 import sys
+import tempfile
+import time
 import tqdm #
 import uuid
+import zlib
 
 # -----=====| CONST |=====-----
 
 DATA_CHUNK_SIZE = 108
 RUNID_BLOCK_SIZE = 4
 INDEX_BLOCK_SIZE = 4
-QR_ERROR_CORRECTION = 1
+QR_ERROR_CORRECTION = ERROR_CORRECT_L
+QR_VERSION = None
+QR_ERROR_CORRECTION_LEVELS = { 'L': ERROR_CORRECT_L, 'M': ERROR_CORRECT_M, 'Q': ERROR_CORRECT_Q, 'H': ERROR_CORRECT_H }
 ARUCO_DICTIONARY = cv2.aruco.DICT_5X5_50
 MIN_MARKER_PERIMETER_RATE = 1e-9
+LOCALIZATION = 'coarse'
+LOCALIZATION_MODES = ('coarse', 'full')
+MARKER_SEARCH_SIZE = 2400
+COARSE_MIN_MARKER_PERIMETER_RATE = 0.02
+REFINE_MIN_MARKER_PERIMETER_RATE = 0.1
+MARKER_THRESHOLD_WINDOW = 23
+MARKER_PIXELS_PER_BIT = 8
+MARKER_REFINE_MARGIN = 1.0
+MARKER_PREDICT_MARGIN = 8.0
 SPACING_SIZE = 7
 COLUMNS_NUM = 6
 ROWS_NUM = 8
@@ -48,317 +71,1093 @@ PDF_FONT_FAMILY = 'Courier-Bold'
 PDF_FONT_SIZE = 10
 PDF_LINE_SPACING = 5
 TQDM_STATUSBAR_ASCII = '.#'
+HEADER_BLOCK_SIZE = 52
+BASE64_ALPHABET = numpy.frombuffer(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/', dtype = numpy.uint8)
+DECODE_JOBS = 1
+ENCODE_JOBS = 1
+POOL_WINDOW = 8
+OUTPUT_FORMAT = 'pdf'
+RASTER_DPI = 300
+PDF_SCAN_DPI = 300
+PDF_SIGNATURE = b'%PDF'
+TIFF_SIGNATURES = (b'II*\x00', b'MM\x00*')
+READ_BUFFER_SIZE = 81 * 1024
+SERVE_POLL_INTERVAL = 1.0
+BENCHMARK_SIZES = (10000, 50000)
+# Degradation presets; "scan" is close to the Hemingway test scans
+DEGRADATION_PROFILES = {
+	'clean': {},
+	'blur': { 'Blur': 1.5 },
+	'noise': { 'Noise': 25 },
+	'rotation': { 'Rotation': 4 },
+	'perspective': { 'Perspective': 0.08, 'Rotation': 1 },
+	'jpeg': { 'JpegQuality': 25 },
+	'scan': { 'Rotation': 0.8, 'Perspective': 0.01, 'Blur': 0.8, 'Noise': 6, 'JpegQuality': 75 }
+	}
+BLOCK_FORMAT = 2
+BLOCK_FORMATS = (1, 2)
+BLOCK_MARKER = '$'
+QR_DEFAULT_VERSION = 6
+HEADER_FORMAT = '>IQ32sBBHHBB'
+COMPRESSION = 'none'
+# Codec number in the header, compressor and decompressor
+COMPRESSION_CODECS = {
+	'none': (0, None, None),
+	'zlib': (1, lambda: zlib.compressobj(9), zlib.decompress),
+	'lzma': (2, lambda: lzma.LZMACompressor(), lzma.decompress),
+	'bz2': (3, lambda: bz2.BZ2Compressor(9), bz2.decompress)
+	}
+COMPRESSION_MODES = tuple(COMPRESSION_CODECS.keys()) + ('auto',)
+COMPRESSION_SPOOL_SIZE = 64 * 1024 * 1024
+PARITY_OVERHEAD = 0.0
+GALOIS_POLYNOMIAL = 0x11D
+QR_DECODERS = ('pyzbar', 'opencv')
+DECODE_RETRIES = ('threshold', 'deskew', 'upscale')
+BASE45_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:'
 
 
 # -----=====| LOGGING |=====-----
 
 logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.INFO)
 
+# -----=====| METRICS |=====-----
+
+# Timers and counters of the current process; hooks get every observation as it happens
+METRICS = { 'Timers': dict(), 'Counters': dict(), 'Hooks': list(), 'ProgressBars': True }
+
+def AddMetricsHook(Hook):
+	# Hook(Kind, Name, Value): kind is "timer" (value in seconds) or "counter" (increment)
+	METRICS['Hooks'].append(Hook)
+
+def RemoveMetricsHook(Hook): METRICS['Hooks'].remove(Hook)
+
+def ObserveTime(Name, Seconds):
+	Timer = METRICS['Timers'].setdefault(Name, { 'Count': 0, 'Seconds': 0.0, 'Max': 0.0 })
+	Timer['Count'] += 1
+	Timer['Seconds'] += Seconds
+	Timer['Max'] = max(Timer['Max'], Seconds)
+	for Hook in METRICS['Hooks']: Hook('timer', Name, Seconds)
+
+def CountMetric(Name, Value = 1):
+	METRICS['Counters'][Name] = METRICS['Counters'].get(Name, 0) + Value
+	for Hook in METRICS['Hooks']: Hook('counter', Name, Value)
+
+@contextlib.contextmanager
+def StageTimer(Name):
+	# Context manager or function decorator
+	Start = time.perf_counter()
+	try:
+		yield
+	finally:
+		ObserveTime(Name, time.perf_counter() - Start)
+
+def CollectMetrics(Function, **Task):
+	# In a worker process, observations are sent back with the result and replayed by the main one
+	if multiprocessing.parent_process() is None: return Function(**Task), list()
+	Observations, Saved = list(), dict(METRICS)
+	METRICS.update({ 'Timers': dict(), 'Counters': dict(), 'Hooks': [ lambda Kind, Name, Value: Observations.append((Kind, Name, Value)) ] })
+	try:
+		return Function(**Task), Observations
+	finally:
+		METRICS.update(Saved)
+
+def ReplayMetrics(Observations):
+	for Kind, Name, Value in Observations:
+		if Kind == 'timer': ObserveTime(Name, Value)
+		else: CountMetric(Name, Value)
+
+def ResetMetrics():
+	METRICS['Timers'].clear()
+	METRICS['Counters'].clear()
+
+def MetricsReport():
+	return {
+		'Timers': { Name: { 'Count': Timer['Count'], 'Seconds': round(Timer['Seconds'], 6), 'Mean': round(Timer['Seconds'] / Timer['Count'], 6), 'Max': round(Timer['Max'], 6) } for Name, Timer in sorted(METRICS['Timers'].items()) },
+		'Counters': dict(sorted(METRICS['Counters'].items()))
+		}
+
+def SaveMetrics(FileName):
+	with open(FileName, 'wt') as MetricsFile: json.dump(MetricsReport(), MetricsFile, indent = 4)
+
+def ProgressBar(Iterable, **Options):
+	# Bars may be turned off: tqdm costs in tight loops even when hidden
+	if not METRICS['ProgressBars']: return Iterable
+	return tqdm.tqdm(Iterable, ascii = TQDM_STATUSBAR_ASCII, **Options)
+
+
+# -----=====| PARALLEL |=====-----
+
+def PoolMap(Function, Tasks, Executor = None, Window = POOL_WINDOW):
+	# Lazy map in order, tasks are keyword arguments. With a pool, at most Window tasks are in flight,
+	# so long inputs are neither read ahead nor held in memory
+	if Executor is None:
+		yield from (Function(**Task) for Task in Tasks)
+		return
+	def Result(Future):
+		Value, Observations = Future.result()
+		ReplayMetrics(Observations)
+		return Value
+	Pending = list()
+	for Task in Tasks:
+		Pending.append(Executor.submit(CollectMetrics, Function, **Task))
+		if len(Pending) >= Window: yield Result(Pending.pop(0))
+	while Pending: yield Result(Pending.pop(0))
+
 
 # -----=====| CONVERSION |=====-----
 
-def Base64ToInt(String): return int.from_bytes(base64.b64decode(String), 'big')
+def CurrentTimestamp(): return str(datetime.datetime.now().replace(microsecond = 0))
+
+def Base64Numbers(Numbers, Size):
+	# Big-endian base64 of every number at once, Size chars each: array of shape (len(Numbers), Size)
+	Shifts = numpy.arange(Size - 1, -1, -1, dtype = numpy.int64) * 6
+	return BASE64_ALPHABET[(numpy.asarray(Numbers, dtype = numpy.int64)[:, None] >> Shifts) & 63]
+
+def Base45Length(Size): return (3 * (Size // 2)) + (2 * (Size % 2))
+
+def Base45Encode(Data):
+	# RFC 9285: every 2 bytes are 3 base45 digits, least significant first
+	Array = numpy.frombuffer(Data, dtype = numpy.uint8).astype(numpy.uint32)
+	Even = len(Array) - (len(Array) % 2)
+	Values = (Array[0 : Even : 2] << 8) | Array[1 : Even : 2]
+	Digits = numpy.stack([Values % 45, (Values // 45) % 45, Values // 2025], axis = 1).ravel()
+	if len(Array) % 2: Digits = numpy.append(Digits, [Array[-1] % 45, Array[-1] // 45])
+	return numpy.frombuffer(BASE45_ALPHABET.encode('ascii'), dtype = numpy.uint8)[Digits].tobytes().decode('ascii')
+
+def Base45Decode(String):
+	Lookup = numpy.full(256, 255, dtype = numpy.uint8)
+	Lookup[numpy.frombuffer(BASE45_ALPHABET.encode('ascii'), dtype = numpy.uint8)] = numpy.arange(45)
+	Digits = Lookup[numpy.frombuffer(String.encode('ascii'), dtype = numpy.uint8)].astype(numpy.uint32)
+	if (len(Digits) % 3 == 1) or (Digits == 255).any(): raise ValueError(f'Invalid base45 string')
+	Full = len(Digits) - (len(Digits) % 3)
+	Values = Digits[0 : Full : 3] + (Digits[1 : Full : 3] * 45) + (Digits[2 : Full : 3] * 2025)
+	Tail = Digits[Full :: 2] + (Digits[Full + 1 :: 2] * 45)
+	if (Values > 0xFFFF).any() or (Tail > 0xFF).any(): raise ValueError(f'Invalid base45 string')
+	return numpy.stack([Values >> 8, Values & 0xFF], axis = 1).astype(numpy.uint8).tobytes() + Tail.astype(numpy.uint8).tobytes()
+
+@functools.lru_cache(maxsize = None)
+def ScrambleMask(Size): return numpy.frombuffer(hashlib.shake_256(b'pawpyrus').digest(Size), dtype = numpy.uint8)
+
+def Scramble(Data):
+	# Fixed XOR mask, involutory. Long zero runs would give all-zero QR codewords, which python-qrcode cannot encode
+	return (numpy.frombuffer(Data, dtype = numpy.uint8) ^ ScrambleMask(len(Data))).tobytes()
+
+
+# -----=====| ERASURE CODING |=====-----
+
+@functools.lru_cache(maxsize = None)
+def GaloisTables(Polynomial = GALOIS_POLYNOMIAL):
+	# GF(256) arithmetic as lookup tables
+	Exp = numpy.zeros(510, dtype = numpy.int64)
+	Value = 1
+	for Power in range(255):
+		Exp[Power] = Value
+		Value <<= 1
+		if Value & 0x100: Value ^= Polynomial
+	Exp[255:] = Exp[:255]
+	Log = numpy.zeros(256, dtype = numpy.int64)
+	Log[Exp[:255]] = numpy.arange(255)
+	Mul = Exp[Log[:, None] + Log[None, :]].astype(numpy.uint8)
+	Mul[0, :], Mul[:, 0] = 0, 0
+	Inv = Exp[255 - Log].astype(numpy.uint8)
+	Inv[0] = 0
+	return { 'Mul': Mul, 'Inv': Inv }
 
-def IntToBinary(Int, Bits): return f'{Int:b}'.zfill(Bits)
+def GaloisDot(Left, Right):
+	# Matrix product over GF(256): products by table, sums are XOR
+	return numpy.bitwise_xor.reduce(GaloisTables()['Mul'][Left[:, :, None], Right[None, :, :]], axis = 1)
 
-def Base64ToHex(String):
-	return hex(Base64ToInt(String))[2:].zfill(math.ceil(len(String) * 6 / 4))
+def GaloisInverse(Matrix):
+	# Gauss-Jordan elimination over GF(256)
+	Tables = GaloisTables()
+	Size = Matrix.shape[0]
+	Work = numpy.concatenate([Matrix, numpy.eye(Size, dtype = numpy.uint8)], axis = 1)
+	for Col in range(Size):
+		NonZero = numpy.flatnonzero(Work[Col:, Col])
+		if not NonZero.size: raise ValueError(f'Matrix is singular')
+		Pivot = Col + NonZero[0]
+		Work[[Col, Pivot]] = Work[[Pivot, Col]]
+		Work[Col] = Tables['Mul'][Tables['Inv'][Work[Col, Col]], Work[Col]]
+		Factors = Work[:, Col].copy()
+		Factors[Col] = 0
+		Work ^= Tables['Mul'][Factors[:, None], Work[Col][None, :]]
+	return Work[:, Size:]
 
+@functools.lru_cache(maxsize = None)
+def CauchyMatrix(DataNum, ParityNum):
+	# Any square submatrix is invertible, so any DataNum of data and parity blocks restore the stripe
+	Rows = numpy.arange(DataNum, DataNum + ParityNum)
+	Cols = numpy.arange(DataNum)
+	return GaloisTables()['Inv'][Rows[:, None] ^ Cols[None, :]]
 
-# -----=====| GEOMETRY |=====-----
+def ParityLayout(DataNum, Overhead = PARITY_OVERHEAD):
+	# Data blocks are interleaved between stripes of at most 256 blocks, so a lost page hits every stripe a little
+	Result = { 'Stripes': 0, 'DataBlocks': 0, 'ParityBlocks': 0 }
+	if (not Overhead) or (not DataNum): return Result
+	if Overhead < 0: raise ValueError(f'Parity overhead must be positive')
+	MaxDataNum = max([ Num for Num in range(1, 256) if Num + math.ceil(Num * Overhead) <= 256 ], default = None)
+	if MaxDataNum is None: raise ValueError(f'Parity overhead {Overhead} is too big')
+	Result['Stripes'] = math.ceil(DataNum / MaxDataNum)
+	Result['DataBlocks'] = math.ceil(DataNum / Result['Stripes'])
+	Result['ParityBlocks'] = math.ceil(Result['DataBlocks'] * Overhead)
+	return Result
+
+def ChunkArray(Contents, ChunkSize):
+	# Short chunks are padded with zeros
+	Array = numpy.zeros((len(Contents), ChunkSize), dtype = numpy.uint8)
+	for Index, Content in enumerate(Contents): Array[Index, : len(Content)] = numpy.frombuffer(Content, dtype = numpy.uint8)
+	return Array
 
-def FindCenter(CoordBlock):
-	return (
-		CoordBlock[0][0] + ((CoordBlock[2][0] - CoordBlock[0][0]) / 2),
-		CoordBlock[0][1] + ((CoordBlock[2][1] - CoordBlock[0][1]) / 2)
-		)
+def RecoverBlocks(Extracted, Metadata):
+	# Returns restored contents of missing data blocks, stripe by stripe
+	Result = dict()
+	DataNum = Metadata['Length'] - 1
+	Stripes, ParityNum = Metadata['Stripes'], Metadata['ParityBlocks']
+	StripeSize = math.ceil(DataNum / Stripes)
+	Coefficients = CauchyMatrix(StripeSize, ParityNum)
+	for Stripe in range(Stripes):
+		# Stripe positions past the end of data are zeros
+		Indices = [ 1 + Stripe + (Position * Stripes) for Position in range(StripeSize) ]
+		Missing = [ Position for Position, Index in enumerate(Indices) if (Index < Metadata['Length']) and (Index not in Extracted) ]
+		if not Missing: continue
+		ParityIndices = [ Metadata['Length'] + Stripe + (Row * Stripes) for Row in range(ParityNum) ]
+		Rows = [ Row for Row, Index in enumerate(ParityIndices) if Index in Extracted ][: len(Missing)]
+		if len(Rows) < len(Missing): continue
+		# Past the end of data, indices run into parity blocks: those positions are zeros as well
+		Known = ChunkArray([ Extracted[Index]['Content'] if (Index < Metadata['Length']) and (Index in Extracted) else b'' for Index in Indices ], Metadata['ChunkSize'])
+		Known[Missing] = 0
+		Syndrome = ChunkArray([ Extracted[ParityIndices[Row]]['Content'] for Row in Rows ], Metadata['ChunkSize']) ^ GaloisDot(Coefficients[Rows], Known)
+		Restored = GaloisDot(GaloisInverse(Coefficients[Rows][:, Missing]), Syndrome)
+		for Position, Content in zip(Missing, Restored):
+			Index = Indices[Position]
+			# The last chunk is shorter
+			Size = Metadata['Size'] - ((DataNum - 1) * Metadata['ChunkSize']) if Index == DataNum else Metadata['ChunkSize']
+			Result[Index] = Content[: Size].tobytes()
+	return Result
 
 
 # -----=====| DATASET CREATION |=====-----
 
-def CreateDataset(RawData):
+@StageTimer('encode.hash')
+def HashStream(Stream, BufferSize = READ_BUFFER_SIZE, Codecs = ()):
+	# Compressed copies are made in the same pass, spooled to disk if large
+	Result = { 'Hash': hashlib.sha256(), 'Size': 0, 'Compressed': { Name: tempfile.SpooledTemporaryFile(COMPRESSION_SPOOL_SIZE) for Name in Codecs } }
+	Compressors = { Name: COMPRESSION_CODECS[Name][1]() for Name in Codecs }
+	for Raw in iter(functools.partial(Stream.read, BufferSize), b''):
+		Result['Hash'].update(Raw)
+		Result['Size'] += len(Raw)
+		for Name, Compressor in Compressors.items(): Result['Compressed'][Name].write(Compressor.compress(Raw))
+	for Name, Compressor in Compressors.items(): Result['Compressed'][Name].write(Compressor.flush())
+	return Result
+
+def Base64Stream(Stream, ChunkSize = DATA_CHUNK_SIZE, BufferSize = READ_BUFFER_SIZE):
+	# Base64 maps every 3 bytes to 4 chars, so the stream may be encoded piecewise.
+	# Pieces hold whole chunks, except the last one
+	Tail, Encoded = b'', b''
+	for Raw in iter(functools.partial(Stream.read, BufferSize), b''):
+		Raw = Tail + Raw
+		Cut = len(Raw) - (len(Raw) % 3)
+		Encoded += base64.b64encode(Raw[:Cut])
+		Tail = Raw[Cut:]
+		Cut = len(Encoded) - (len(Encoded) % ChunkSize)
+		if Cut: yield Encoded[:Cut]
+		Encoded = Encoded[Cut:]
+	Encoded += base64.b64encode(Tail)
+	if Encoded: yield Encoded
+
+def CreateBlocks(Stream, Header, RunID, ChunkSize = DATA_CHUNK_SIZE, RunIDBlockSize = RUNID_BLOCK_SIZE, IndexBlockSize = INDEX_BLOCK_SIZE):
+	# Block: base64 of Run ID and block number, then base64 chunk.
+	# Whole chunks of a read buffer are framed at once, as rows of one array
+	Prefix = Base64Numbers([RunID], RunIDBlockSize)
+	def Tags(Start, Count): return numpy.hstack([numpy.repeat(Prefix, Count, axis = 0), Base64Numbers(numpy.arange(Start, Start + Count), IndexBlockSize)])
+	yield Tags(0, 1).tobytes() + Header
+	Index = 1
+	for Piece in Base64Stream(Stream, ChunkSize):
+		Count, Rest = divmod(len(Piece), ChunkSize)
+		Frames = numpy.hstack([Tags(Index, Count), numpy.frombuffer(Piece, dtype = numpy.uint8, count = Count * ChunkSize).reshape(Count, ChunkSize)])
+		yield from map(numpy.ndarray.tobytes, Frames)
+		Index += Count
+		if Rest:
+			yield Tags(Index, 1).tobytes() + Piece[Count * ChunkSize :]
+			Index += 1
+
+def CreateBinaryBlocks(Stream, Header, RunID, ChunkSize, Layout = None, RunIDBlockSize = RUNID_BLOCK_SIZE, IndexBlockSize = INDEX_BLOCK_SIZE, Close = False):
+	# Block: marker + base45 of format, Run ID, block number and scrambled raw bytes.
+	# Stream is closed when blocks are over if it is owned, e.g. a compressed copy
+	Prefix = bytes([2]) + RunID.to_bytes(RunIDBlockSize * 6 // 8, 'big')
+	def CreateBlock(Index, Content): return (BLOCK_MARKER + Base45Encode(Prefix + Index.to_bytes(IndexBlockSize * 6 // 8, 'big') + Scramble(Content))).encode('ascii')
+	if Layout is None: Layout = ParityLayout(0)
+	yield CreateBlock(0, Header)
+	# Parity is accumulated row by row: a row holds one data block of every stripe
+	Parity = numpy.zeros((Layout['Stripes'], Layout['ParityBlocks'], ChunkSize), dtype = numpy.uint8)
+	Coefficients = CauchyMatrix(Layout['DataBlocks'], Layout['ParityBlocks'])
+	Index = 1
+	try:
+		for Row, Contents in enumerate(chunked(iter(functools.partial(Stream.read, ChunkSize), b''), max(Layout['Stripes'], 1))):
+			if Layout['ParityBlocks']: Parity[: len(Contents)] ^= GaloisTables()['Mul'][Coefficients[:, Row][None, :, None], ChunkArray(Contents, ChunkSize)[:, None, :]]
+			for Content in Contents:
+				yield CreateBlock(Index, Content)
+				Index += 1
+	finally:
+		if Close: Stream.close()
+	# Parity blocks, a header copy before every row of them
+	for Row in range(Layout['ParityBlocks']):
+		yield CreateBlock(0, Header)
+		for Stripe in range(Layout['Stripes']):
+			yield CreateBlock(Index, Parity[Stripe, Row].tobytes())
+			Index += 1
+
+def HeaderSize(BlockFormat = BLOCK_FORMAT): return HEADER_BLOCK_SIZE if BlockFormat == 1 else struct.calcsize(HEADER_FORMAT)
+
+def QRInput(Block):
+	# Format 2 blocks are alphanumeric, format 1 blocks are base64 text in byte mode
+	return QRData(Block, mode = MODE_ALPHA_NUM) if Block[:1] == BLOCK_MARKER.encode('ascii') else Block
+
+def SampleBlock(ChunkSize, BlockFormat = BLOCK_FORMAT, RunIDBlockSize = RUNID_BLOCK_SIZE, IndexBlockSize = INDEX_BLOCK_SIZE):
+	# The longest block of the chunk size; byte mode is the worst case for base64 text
+	if BlockFormat == 1: return b'=' * (ChunkSize + RunIDBlockSize + IndexBlockSize)
+	return QRInput(BLOCK_MARKER.encode('ascii') * (1 + Base45Length(1 + ((RunIDBlockSize + IndexBlockSize) * 6 // 8) + ChunkSize)))
+
+def FitsQR(ChunkSize, QRVersion, ErrorCorrection = QR_ERROR_CORRECTION, BlockFormat = BLOCK_FORMAT):
+	QR = QRCode(version = QRVersion, error_correction = ErrorCorrection, border = 0)
+	QR.add_data(SampleBlock(ChunkSize, BlockFormat))
+	try:
+		QR.make(fit = False)
+	except DataOverflowError:
+		return False
+	return True
+
+def FitQRVersion(ChunkSize, ErrorCorrection = QR_ERROR_CORRECTION, BlockFormat = BLOCK_FORMAT, RunIDBlockSize = RUNID_BLOCK_SIZE, IndexBlockSize = INDEX_BLOCK_SIZE):
+	QR = QRCode(error_correction = ErrorCorrection, border = 0)
+	QR.add_data(SampleBlock(ChunkSize, BlockFormat, RunIDBlockSize, IndexBlockSize))
+	try:
+		return QR.best_fit()
+	except DataOverflowError:
+		raise ValueError(f'Chunk size {ChunkSize} does not fit any QR version')
+
+@functools.lru_cache(maxsize = None)
+def FitChunkSize(QRVersion, ErrorCorrection = QR_ERROR_CORRECTION, BlockFormat = BLOCK_FORMAT):
+	# The largest chunk that fits the QR version. Base64 chunks are multiples of 4 to keep every block valid base64
+	Step = 4 if BlockFormat == 1 else 1
+	Low, High = 0, 4096 // Step
+	while Low < High:
+		Middle = (Low + High + 1) // 2
+		if FitsQR(Middle * Step, QRVersion, ErrorCorrection, BlockFormat): Low = Middle
+		else: High = Middle - 1
+	if Low * Step < HeaderSize(BlockFormat): raise ValueError(f'QR version {QRVersion} is too small for the header block')
+	return Low * Step
+
+def CreateDataset(Input, ChunkSize = None, QRVersion = QR_VERSION, ErrorCorrection = QR_ERROR_CORRECTION, BlockFormat = BLOCK_FORMAT, Parity = PARITY_OVERHEAD, Compression = COMPRESSION, RunID = None):
+	# Input is either bytes or a seekable binary stream, which is read twice
+	Stream = io.BytesIO(Input) if isinstance(Input, (bytes, bytearray)) else Input
+	Start = Stream.tell()
+	if BlockFormat not in BLOCK_FORMATS: raise ValueError(f'Unknown block format: {BlockFormat}')
+	if Parity and (BlockFormat == 1): raise ValueError(f'Parity blocks need block format 2')
+	if Compression not in COMPRESSION_MODES: raise ValueError(f'Unknown compression: {Compression}')
+	if (Compression != 'none') and (BlockFormat == 1): raise ValueError(f'Compression needs block format 2')
+	if (RunID is not None) and (not 0 <= RunID < 2 ** (RUNID_BLOCK_SIZE * 6)): raise ValueError(f'Run ID must be {RUNID_BLOCK_SIZE * 6} bits long')
+	# QR parameters: chunk size may be fitted to QR version, and vice versa
+	if ChunkSize is None:
+		if QRVersion is None: QRVersion = QR_DEFAULT_VERSION
+		ChunkSize = FitChunkSize(QRVersion, ErrorCorrection, BlockFormat)
+	if ChunkSize < HeaderSize(BlockFormat): raise ValueError(f'Chunk size must be at least {HeaderSize(BlockFormat)}')
+	if QRVersion is None: QRVersion = FitQRVersion(ChunkSize, ErrorCorrection, BlockFormat)
+	elif not FitsQR(ChunkSize, QRVersion, ErrorCorrection, BlockFormat): raise ValueError(f'Chunk size {ChunkSize} does not fit QR version {QRVersion}')
 	# Create output struct
-	Result = { 'RunID': {}, 'Hash': {}, 'Length': {}, 'Codes': [] }
-	# Run ID: unique program run identifier
-	Result['RunID']['int'] = secrets.randbits(RUNID_BLOCK_SIZE * 6)
-	Result['RunID']['hex'] = hex(Result['RunID']['int'])[2:]
-	Result['RunID']['bin'] = IntToBinary(Result['RunID']['int'], RUNID_BLOCK_SIZE * 6)
-	# Compute data hash
-	Hash = hashlib.sha256(RawData)
-	Result['Hash']['hex'] = Hash.hexdigest()
-	BitarrayObject = bitarray.bitarray()
-	BitarrayObject.frombytes(Hash.digest())
-	Result['Hash']['bin'] = BitarrayObject.to01()
-	# Encode and chunk raw data
-	Codes = list(sliced(base64.b64encode(RawData), DATA_CHUNK_SIZE))
+	Result = { 'RunID': {}, 'Hash': {}, 'Length': {}, 'Size': None, 'StoredSize': None, 'Compression': 'none', 'ChunkSize': ChunkSize, 'QRVersion': QRVersion, 'ErrorCorrection': ErrorCorrection, 'BlockFormat': BlockFormat, 'Parity': None, 'Total': None, 'Codes': None }
+	# Run ID: unique program run identifier, may be pinned for reproducible output
+	Result['RunID']['int'] = secrets.randbits(RUNID_BLOCK_SIZE * 6) if RunID is None else RunID
+	Result['RunID']['hex'] = hex(Result['RunID']['int'])[2:].zfill(RUNID_BLOCK_SIZE * 6 // 4)
+	# Compute data hash and compress: first pass. Hash is of the original data
+	Codecs = [ Name for Name in COMPRESSION_CODECS if Name != 'none' ] if Compression == 'auto' else [ Name for Name in [Compression] if Name != 'none' ]
+	Hashed = HashStream(Stream, Codecs = Codecs)
+	Result['Size'] = Hashed['Size']
+	Result['StoredSize'] = Hashed['Size']
+	# Auto mode keeps the smallest compressed copy, and only if it is smaller than the data
+	for Name, Compressed in Hashed['Compressed'].items():
+		if (Compression != 'auto') or (Compressed.tell() < Result['StoredSize']): Result['Compression'], Result['StoredSize'] = Name, Compressed.tell()
+	# Other copies are dropped at once, the chosen one is closed by the block generator
+	for Name, Compressed in Hashed['Compressed'].items():
+		if Name != Result['Compression']: Compressed.close()
+	if Result['Compression'] != 'none': Stream, Start = Hashed['Compressed'][Result['Compression']], 0
+	Result['Hash']['hex'] = Hashed['Hash'].hexdigest()
 	# Encode length
-	Result['Length']['int'] = int(len(Codes) + 1)
-	Result['Length']['bin'] = IntToBinary(Result['Length']['int'], INDEX_BLOCK_SIZE * 6)
-	# Create header
-	Header = bitarray.bitarray(Result['Length']['bin'] + Result['Hash']['bin']).tobytes()
-	Codes.insert(0, base64.b64encode(Header))
-	# Add block tag: Run ID + block number
-	for Index, Content in tqdm.tqdm(enumerate(Codes), total = Result['Length']['int'], desc = 'Create blocks', ascii = TQDM_STATUSBAR_ASCII):
-		IndexBinary = IntToBinary(Index, INDEX_BLOCK_SIZE * 6)
-		BlockTag = bitarray.bitarray(Result['RunID']['bin'] + IndexBinary).tobytes()
-		Result['Codes'].append(base64.b64encode(BlockTag) + Content)
+	if BlockFormat == 1: Result['Length']['int'] = int(math.ceil(math.ceil(Result['Size'] / 3) * 4 / ChunkSize) + 1)
+	else: Result['Length']['int'] = math.ceil(Result['StoredSize'] / ChunkSize) + 1
+	# Parity blocks and header copies follow data blocks
+	Result['Parity'] = ParityLayout(Result['Length']['int'] - 1, Parity)
+	Result['Total'] = Result['Length']['int'] + (Result['Parity']['ParityBlocks'] * (Result['Parity']['Stripes'] + 1))
+	if Result['Total'] >= 2 ** (INDEX_BLOCK_SIZE * 6):
+		if Result['Compression'] != 'none': Stream.close()
+		raise ValueError(f'Too many blocks: {Result["Total"]}, increase chunk size')
+	# Encode and chunk raw data: second pass, lazy
+	Stream.seek(Start)
+	if BlockFormat == 1:
+		# Create header: length, hash, QR parameters
+		Header = Result['Length']['int'].to_bytes(INDEX_BLOCK_SIZE * 6 // 8, 'big') + Hashed['Hash'].digest() + struct.pack('>BBH', QRVersion, ErrorCorrection, ChunkSize)
+		Result['Codes'] = CreateBlocks(Stream, base64.b64encode(Header), Result['RunID']['int'], ChunkSize)
+	else:
+		# Create header: length, stored size, hash, QR parameters, parity layout, compression
+		Header = struct.pack(HEADER_FORMAT, Result['Length']['int'], Result['StoredSize'], Hashed['Hash'].digest(), QRVersion, ErrorCorrection, ChunkSize, Result['Parity']['Stripes'], Result['Parity']['ParityBlocks'], COMPRESSION_CODECS[Result['Compression']][0])
+		Result['Codes'] = CreateBinaryBlocks(Stream, Header, Result['RunID']['int'], ChunkSize, Result['Parity'], Close = Result['Compression'] != 'none')
 	# Return
 	return Result
 
 
 # -----=====| PAWPRINTS |=====-----
 
-def TomcatPawprint(Data, Coords, PawSize = None, ChunkSize = DATA_CHUNK_SIZE, RunIDBlockSize = RUNID_BLOCK_SIZE, IndexBlockSize = INDEX_BLOCK_SIZE, ErrorCorrection = QR_ERROR_CORRECTION):
-	WrappedData = Data.ljust(ChunkSize + RunIDBlockSize + IndexBlockSize, b'=')
-	QR = QRCode(error_correction = ErrorCorrection, border = 0)
-	QR.add_data(WrappedData)
+@StageTimer('encode.qr_matrix')
+def TomcatMatrix(Data, PawSize = None, ChunkSize = DATA_CHUNK_SIZE, RunIDBlockSize = RUNID_BLOCK_SIZE, IndexBlockSize = INDEX_BLOCK_SIZE, ErrorCorrection = QR_ERROR_CORRECTION, QRVersion = QR_VERSION):
+	# Format 1 blocks are padded to fit the same QR version
+	WrappedData = Data if Data[:1] == BLOCK_MARKER.encode('ascii') else Data.ljust(ChunkSize + RunIDBlockSize + IndexBlockSize, b'=')
+	QR = QRCode(version = QRVersion, error_correction = ErrorCorrection, border = 0)
+	QR.add_data(QRInput(WrappedData))
 	QR.make(fit = False)
-	Matrix = QR.get_matrix()
-	Result = { 'PawSize': len(Matrix) }
-	if (PawSize is not None) and (Result['PawSize'] != PawSize): raise RuntimeError(f'Some pawprints have wrong size. Change DATA_CHUNK_SIZE const')
-	PixelCoordinates = itertools.product(range(Result['PawSize']), repeat = 2)
-	Result['Pixels'] = [ (Coords[0] + X, Coords[1] + Y) for Y, X in PixelCoordinates if Matrix[Y][X] ]
-	return Result
+	Matrix = numpy.array(QR.modules, dtype = bool)
+	if (PawSize is not None) and (Matrix.shape[0] != PawSize): raise RuntimeError(f'Some pawprints have wrong size. Check chunk size and QR version')
+	return Matrix
+
+@functools.lru_cache(maxsize = None)
+def KittyMatrix(ArUcoIndex, Dictionary = ARUCO_DICTIONARY, SpacingSize = SPACING_SIZE):
+	Matrix = cv2.aruco.Dictionary_get(Dictionary).drawMarker(ArUcoIndex, SpacingSize) == 0
+	# Shared between pages, so read-only
+	Matrix.flags.writeable = False
+	return Matrix
+
+def MatrixToPixels(Matrix, Coords):
+	Ys, Xs = numpy.nonzero(Matrix)
+	return [ (Coords[0] + int(X), Coords[1] + int(Y)) for Y, X in zip(Ys, Xs) ]
+
+def TomcatPawprint(Data, Coords, PawSize = None, ChunkSize = DATA_CHUNK_SIZE, RunIDBlockSize = RUNID_BLOCK_SIZE, IndexBlockSize = INDEX_BLOCK_SIZE, ErrorCorrection = QR_ERROR_CORRECTION):
+	Matrix = TomcatMatrix(Data, PawSize, ChunkSize, RunIDBlockSize, IndexBlockSize, ErrorCorrection)
+	return { 'PawSize': Matrix.shape[0], 'Pixels': MatrixToPixels(Matrix, Coords) }
 
 def KittyPawprint(ArUcoIndex, Coords, Dictionary = ARUCO_DICTIONARY, SpacingSize = SPACING_SIZE):
-	Matrix = cv2.aruco.Dictionary_get(Dictionary).drawMarker(ArUcoIndex, SpacingSize)
-	PixelCoordinates = itertools.product(range(SpacingSize), repeat = 2)
-	Result = [ (Coords[0] + X, Coords[1] + Y) for Y, X in PixelCoordinates if Matrix[Y][X] == 0 ]
-	return Result
+	return MatrixToPixels(KittyMatrix(ArUcoIndex, Dictionary, SpacingSize), Coords)
 
 
 # -----=====| DRAW FUNCTIONS |=====-----
 
-def CreatePixelSheets(Codes, ColNum, RowNum, SpacingSize = SPACING_SIZE, DotSpacing = DOT_SPACING):
+def MarkerPositions(CellSize, ColNum, RowNum, SpacingSize = SPACING_SIZE):
+	# Marker 4, under the last column, makes perspective measurable. Absent in older printouts
+	return {
+		0: (0, 0),
+		1: (CellSize * ColNum, 0),
+		2: (0, CellSize * RowNum),
+		3: (CellSize, 0),
+		4: (CellSize * ColNum, (CellSize * RowNum) + (SpacingSize * 2))
+		}
+
+@StageTimer('encode.pixel_sheet')
+def CreatePixelSheet(Page, ColNum, PawSize, CellSize, PageNumber = 0, PagesNumber = 1, SpacingSize = SPACING_SIZE, DotSpacing = DOT_SPACING, ChunkSize = DATA_CHUNK_SIZE, ErrorCorrection = QR_ERROR_CORRECTION, QRVersion = QR_VERSION, Progress = True):
+	# Create page: bitmap, True is black
+	RowNum = math.ceil(len(Page) / ColNum)
+	PixelSheet = numpy.zeros(((CellSize * RowNum) + (SpacingSize * 3), (CellSize * ColNum) + SpacingSize), dtype = bool)
+	for Index, Code in ProgressBar(enumerate(Page), total = len(Page), desc = f'Create pawprints, page {PageNumber + 1} of {PagesNumber}', disable = not Progress):
+		# Create pawprint on the page
+		Row, Col = divmod(Index, ColNum)
+		StartX = (SpacingSize * 2) + (Col * CellSize)
+		StartY = (SpacingSize * 2) + (Row * CellSize)
+		PixelSheet[StartY : StartY + PawSize, StartX : StartX + PawSize] = TomcatMatrix(Code, PawSize = PawSize, ChunkSize = ChunkSize, ErrorCorrection = ErrorCorrection, QRVersion = QRVersion)
+	# Create grid
+	Grid = MarkerPositions(CellSize, ColNum, RowNum, SpacingSize)
+	for Index, (X, Y) in Grid.items(): PixelSheet[Y : Y + SpacingSize, X : X + SpacingSize] |= KittyMatrix(Index, SpacingSize = SpacingSize)
+	# Create dot margin (beauty, no functionality)
+	DotCentering = math.floor(SpacingSize / 2)
+	PixelSheet[SpacingSize + 2 : (CellSize * RowNum) - 2 : DotSpacing, DotCentering] = True
+	PixelSheet[DotCentering, SpacingSize + 2 : PawSize + SpacingSize - 2 : DotSpacing] = True
+	PixelSheet[DotCentering, PawSize + (SpacingSize * 2) + 2 : (CellSize * ColNum) - 2 : DotSpacing] = True
+	return PixelSheet
+
+def CreatePixelSheets(Codes, ColNum, RowNum, Length = None, SpacingSize = SPACING_SIZE, DotSpacing = DOT_SPACING, ChunkSize = DATA_CHUNK_SIZE, ErrorCorrection = QR_ERROR_CORRECTION, QRVersion = QR_VERSION, Executor = None):
+	# Codes may be a lazy iterator, then its length must be given
+	if Length is None: Length = len(Codes)
+	Codes = iter(Codes)
 	# Create output struct
-	Result = { 'PawSize': None, 'CellSize': None, 'Pages': list() }
-	# Chunk codes to rows and pages
-	PageData = list(sliced(list(sliced(Codes, ColNum)), RowNum))
-	for PageNumber, Page in enumerate(PageData):
-		# Create page
-		PixelSheet = list()
-		for Row, Col in tqdm.tqdm(itertools.product(range(RowNum), range(ColNum)), total = sum([len(item) for item in Page]), desc = f'Create pawprints, page {PageNumber + 1} of {len(PageData)}', ascii = TQDM_STATUSBAR_ASCII):
-			try:
-				# Create pawprint on the page
-				# Align pawprints by ROOT BLOCK pawsize!
-				StartX = (SpacingSize * 2) + (0 if Result['CellSize'] is None else Col * Result['CellSize'])
-				StartY = (SpacingSize * 2) + (0 if Result['CellSize'] is None else Row * Result['CellSize'])
-				Pawprint = TomcatPawprint(Page[Row][Col], (StartX, StartY), PawSize = Result['PawSize'])
-				if Result['PawSize'] is None:
-					Result['PawSize'] = int(Pawprint['PawSize'])
-					Result['CellSize'] = int(Pawprint['PawSize'] + SpacingSize)
-				PixelSheet += Pawprint['Pixels']
-			except IndexError:
-				# If there are no codes left
-				break
-		# Create grid
-		Grid = {
-			0: (0, 0),
-			1: (Result['CellSize'] * ColNum, 0),
-			2: (0, Result['CellSize'] * len(Page)),
-			3: (Result['CellSize'], 0)
-			}
-		for Index, Item in Grid.items(): PixelSheet += KittyPawprint(Index, Item)
-		# Create dot margin (beauty, no functionality)
-		DotCentering = math.floor(SpacingSize / 2)
-		for Y in list(range(SpacingSize + 2, (Result['CellSize'] * len(Page)) - 2, DotSpacing)):
-			PixelSheet.append((DotCentering, int(Y)))
-		for X in (
-			list(range(SpacingSize + 2, Result['PawSize'] + SpacingSize - 2, DotSpacing)) +
-			list(range(Result['PawSize'] + (SpacingSize * 2) + 2, (Result['CellSize'] * ColNum) - 2, DotSpacing))
-			):
-			PixelSheet.append((int(X), DotCentering))
-		# Append page
-		Result['Pages'].append(PixelSheet)
+	Result = { 'ColNum': ColNum, 'RowNum': RowNum, 'PawSize': None, 'CellSize': None, 'PagesNumber': math.ceil(Length / (ColNum * RowNum)), 'Pages': None }
+	# Align pawprints by ROOT BLOCK pawsize!
+	Root = next(Codes)
+	Result['PawSize'] = int(TomcatMatrix(Root, ChunkSize = ChunkSize, ErrorCorrection = ErrorCorrection, QRVersion = QRVersion).shape[0])
+	Result['CellSize'] = int(Result['PawSize'] + SpacingSize)
+	# Pages are created on demand, one at a time, or a few at once by the pool
+	def Tasks():
+		for PageNumber, Page in enumerate(chunked(itertools.chain([Root], Codes), ColNum * RowNum)):
+			CountMetric('encode.pages')
+			CountMetric('encode.blocks', len(Page))
+			yield { 'Page': Page, 'PageNumber': PageNumber }
+	Sheet = functools.partial(CreatePixelSheet, ColNum = ColNum, PawSize = Result['PawSize'], CellSize = Result['CellSize'], PagesNumber = Result['PagesNumber'], SpacingSize = SpacingSize, DotSpacing = DotSpacing, ChunkSize = ChunkSize, ErrorCorrection = ErrorCorrection, QRVersion = QRVersion, Progress = Executor is None)
+	Result['Pages'] = PoolMap(Sheet, Tasks(), Executor)
 	# Return
 	return Result
 
+@StageTimer('encode.svg_page')
+def DrawSVGPage(Page, PixelSize, PageNumber = 0, PagesNumber = 1, PdfPageWidth = PDF_PAGE_WIDTH, PdfPageHeight = PDF_PAGE_HEIGHT):
+	# Draw page
+	SvgPage = [
+		f'<svg width="{PdfPageWidth}mm" height="{PdfPageHeight}mm" viewBox="0 0 {PdfPageWidth} {PdfPageHeight}" version="1.1" xmlns="http://www.w3.org/2000/svg">',
+		f'<path style="fill:#000000;stroke:none;fill-rule:evenodd" d="'
+		]
+	Paths = list()
+	# Add pixel runs
+	for X, Y, Width in ProgressBar(MergeRuns(Page).tolist(), desc = f'Draw pixels, page {PageNumber + 1} of {PagesNumber}'):
+		Paths.append(f'M {X * PixelSize},{Y * PixelSize} H {(X + Width) * PixelSize} V {(Y + 1) * PixelSize} H {X * PixelSize} Z')
+	SvgPage.append(f' '.join(Paths))
+	SvgPage.append(f'"/>')
+	SvgPage.append(f'</svg>')
+	# Merge svg
+	return '\n'.join(SvgPage)
+
+def GetPixelSize(ColNum, CellSize, SpacingSize = SPACING_SIZE, PdfPageWidth = PDF_PAGE_WIDTH, PdfLeftMargin = PDF_LEFT_MARGIN, PdfRightMargin = PDF_RIGHT_MARGIN):
+	DrawingWidth = (ColNum * CellSize) + SpacingSize
+	return (PdfPageWidth - PdfLeftMargin - PdfRightMargin) / DrawingWidth
+
+def PagePixelSize(PixelSheets, SpacingSize = SPACING_SIZE, PdfPageWidth = PDF_PAGE_WIDTH, PdfLeftMargin = PDF_LEFT_MARGIN, PdfRightMargin = PDF_RIGHT_MARGIN, PdfTopMargin = PDF_TOP_MARGIN, PdfLineSpacing = PDF_LINE_SPACING):
+	# Drawing is as wide as the margins allow, so it must fit between the captions and the bottom edge by height
+	PixelSize = GetPixelSize(PixelSheets['ColNum'], PixelSheets['CellSize'], SpacingSize, PdfPageWidth, PdfLeftMargin, PdfRightMargin)
+	Height = ((PixelSheets['CellSize'] * PixelSheets['RowNum']) + (SpacingSize * 3)) * PixelSize
+	Available = PdfTopMargin - (PdfLineSpacing * 5)
+	if Height > Available: raise ValueError(f'Layout {PixelSheets["ColNum"]} x {PixelSheets["RowNum"]} does not fit the page: drawing is {Height:.0f} mm tall, {Available:.0f} mm available. Use fewer rows or more columns')
+	return PixelSize
+
 def DrawSVG(PixelSheets, ColNum, SpacingSize = SPACING_SIZE, PdfPageWidth = PDF_PAGE_WIDTH, PdfPageHeight = PDF_PAGE_HEIGHT, PdfLeftMargin = PDF_LEFT_MARGIN, PdfRightMargin = PDF_RIGHT_MARGIN):
-	SvgPages = list()
-	DrawingWidth = (ColNum * PixelSheets['CellSize']) + SpacingSize
-	PixelSize = (PdfPageWidth - PdfLeftMargin - PdfRightMargin) / DrawingWidth
+	PixelSize = GetPixelSize(ColNum, PixelSheets['CellSize'], SpacingSize, PdfPageWidth, PdfLeftMargin, PdfRightMargin)
+	# Pages are drawn on demand, one at a time
 	for PageNumber, Page in enumerate(PixelSheets['Pages']):
-		# Draw page
-		SvgPage = [
-			f'<svg width="{PdfPageWidth}mm" height="{PdfPageHeight}mm" viewBox="0 0 {PdfPageWidth} {PdfPageHeight}" version="1.1" xmlns="http://www.w3.org/2000/svg">',
-			f'<path style="fill:#000000;stroke:none;fill-rule:evenodd" d="'
-			]
-		Paths = list()
-		# Add Pixels
-		for X, Y in tqdm.tqdm(Page, total = len(Page), desc = f'Draw pixels, page {PageNumber + 1} of {len(PixelSheets["Pages"])}', ascii = TQDM_STATUSBAR_ASCII):
-			Paths.append(f'M {X * PixelSize},{Y * PixelSize} H {(X + 1) * PixelSize} V {(Y + 1) * PixelSize} H {X * PixelSize} Z')
-		SvgPage.append(f' '.join(Paths))
-		SvgPage.append(f'</svg>')
-		# Merge svg
-		SvgPages.append('\n'.join(SvgPage))
-	return SvgPages
-
-def CreatePDF(Dataset, SvgPages, OutputFileName, JobName, PdfLeftMargin = PDF_LEFT_MARGIN, PdfTopMargin = PDF_TOP_MARGIN, PdfLineSpacing = PDF_LINE_SPACING, PdfFontFamily = PDF_FONT_FAMILY, PdfFontSize = PDF_FONT_SIZE, PdfPageHeight = PDF_PAGE_HEIGHT):
-	CanvasPDF = canvas.Canvas(OutputFileName)
-	Timestamp = str(datetime.datetime.now().replace(microsecond = 0))
-	for PageNumber, Page in tqdm.tqdm(enumerate(SvgPages), total = len(SvgPages), desc = f'Convert pages to PDF', ascii = TQDM_STATUSBAR_ASCII):
+		yield DrawSVGPage(Page, PixelSize, PageNumber, PixelSheets['PagesNumber'], PdfPageWidth, PdfPageHeight)
+
+def ExportSVG(PixelSheets, SvgDir, SpacingSize = SPACING_SIZE, PdfPageWidth = PDF_PAGE_WIDTH, PdfPageHeight = PDF_PAGE_HEIGHT, PdfLeftMargin = PDF_LEFT_MARGIN, PdfRightMargin = PDF_RIGHT_MARGIN):
+	# Save every page as SVG on its way further
+	PixelSize = GetPixelSize(PixelSheets['ColNum'], PixelSheets['CellSize'], SpacingSize, PdfPageWidth, PdfLeftMargin, PdfRightMargin)
+	def SavePage(PageNumber, Page):
+		with open(os.path.join(SvgDir, f'page-{PageNumber + 1}.svg'), 'wt') as SvgFile:
+			SvgFile.write(DrawSVGPage(Page, PixelSize, PageNumber, PixelSheets['PagesNumber'], PdfPageWidth, PdfPageHeight))
+		return Page
+	return dict(PixelSheets, Pages = (SavePage(PageNumber, Page) for PageNumber, Page in enumerate(PixelSheets['Pages'])))
+
+def MergeRuns(Bitmap):
+	# Merge horizontally adjacent pixels into (X, Y, Width) runs, row by row
+	Padded = numpy.pad(Bitmap, ((0, 0), (1, 1))).astype(numpy.int8)
+	Edges = numpy.diff(Padded, axis = 1)
+	StartYs, StartXs = numpy.nonzero(Edges == 1)
+	EndYs, EndXs = numpy.nonzero(Edges == -1)
+	return numpy.column_stack((StartXs, StartYs, EndXs - StartXs))
+
+@StageTimer('encode.pdf_page')
+def PagePath(Page, PixelSize, Left, Top):
+	# One filled path of rectangles per page, coords in mm from the drawing top left corner.
+	# Built apart from the canvas, so pages may be drawn by the pool
+	Path = PDFPathObject()
+	for X, Y, Width in MergeRuns(Page).tolist():
+		Path.rect((Left + (X * PixelSize)) * mm, (Top - ((Y + 1) * PixelSize)) * mm, Width * PixelSize * mm, PixelSize * mm)
+	return Path
+
+def CreateCaptions(Dataset, JobName, Timestamp, PageNumber, PagesNumber):
+	return [
+		f'Name: {JobName}',
+		f'{Timestamp}, run ID: {Dataset["RunID"]["hex"]}, {Dataset["Length"]["int"]} blocks, page {PageNumber + 1} of {PagesNumber}',
+		f'SHA-256: {Dataset["Hash"]["hex"]}',
+		f'pawpyrus {__version__}. Available at: {__repository__}'
+		]
+
+def CreatePDF(Dataset, PixelSheets, OutputFileName, JobName, SpacingSize = SPACING_SIZE, PdfPageWidth = PDF_PAGE_WIDTH, PdfLeftMargin = PDF_LEFT_MARGIN, PdfRightMargin = PDF_RIGHT_MARGIN, PdfTopMargin = PDF_TOP_MARGIN, PdfLineSpacing = PDF_LINE_SPACING, PdfFontFamily = PDF_FONT_FAMILY, PdfFontSize = PDF_FONT_SIZE, Timestamp = None, Executor = None):
+	PixelSize = PagePixelSize(PixelSheets, SpacingSize, PdfPageWidth, PdfLeftMargin, PdfRightMargin, PdfTopMargin, PdfLineSpacing)
+	# Canvas keeps finished pages until saving, so memory still grows with page count: about 110 KB per compressed page
+	# of version 6 pawprints, against a few MB per page uncompressed. Bitmaps and paths are dropped page by page.
+	# Pinned timestamp makes the file reproducible: no creation date and random document ID inside
+	CanvasPDF = canvas.Canvas(OutputFileName, pageCompression = 1, invariant = int(Timestamp is not None))
+	if Timestamp is None: Timestamp = CurrentTimestamp()
+	# Page paths may be drawn by the pool, the canvas takes them in order
+	Draw = functools.partial(PagePath, PixelSize = PixelSize, Left = PdfLeftMargin, Top = PdfTopMargin - (PdfLineSpacing * 5))
+	Paths = PoolMap(Draw, ({ 'Page': Page } for Page in PixelSheets['Pages']), Executor)
+	for PageNumber, Path in ProgressBar(enumerate(Paths), total = PixelSheets['PagesNumber'], desc = f'Draw PDF pages'):
 		# Set font
 		CanvasPDF.setFont(PdfFontFamily, PdfFontSize)
-		# Convert SVG page
-		ObjectPage = svg2rlg(io.StringIO(Page))
 		# Captions
-		CanvasPDF.drawString(PdfLeftMargin * mm, (PdfTopMargin - (PdfLineSpacing * 1)) * mm, f'Name: {JobName}')
-		CanvasPDF.drawString(PdfLeftMargin * mm, (PdfTopMargin - (PdfLineSpacing * 2)) * mm, f'{Timestamp}, run ID: {Dataset["RunID"]["hex"]}, {Dataset["Length"]["int"]} blocks, page {PageNumber + 1} of {len(SvgPages)}')
-		CanvasPDF.drawString(PdfLeftMargin * mm, (PdfTopMargin - (PdfLineSpacing * 3)) * mm, f'SHA-256: {Dataset["Hash"]["hex"]}')
-		CanvasPDF.drawString(PdfLeftMargin * mm, (PdfTopMargin - (PdfLineSpacing * 4)) * mm, f'pawpyrus {__version__}. Available at: {__repository__}')
+		for Line, Caption in enumerate(CreateCaptions(Dataset, JobName, Timestamp, PageNumber, PixelSheets['PagesNumber'])):
+			CanvasPDF.drawString(PdfLeftMargin * mm, (PdfTopMargin - (PdfLineSpacing * (Line + 1))) * mm, Caption)
 		# Draw pawprints
-		renderPDF.draw(ObjectPage, CanvasPDF, PdfLeftMargin * mm, - ((PdfPageHeight - PdfTopMargin) + (PdfLineSpacing * 5)) * mm)
+		CanvasPDF.drawPath(Path, stroke = 0, fill = 1)
 		# Newpage
 		CanvasPDF.showPage()
 	# Save pdf
-	CanvasPDF.save()
+	with StageTimer('encode.pdf_save'): CanvasPDF.save()
+
+
+@StageTimer('encode.raster_page')
+def RasterizePage(Page, PixelSize, Captions, Dpi = RASTER_DPI, PdfPageWidth = PDF_PAGE_WIDTH, PdfPageHeight = PDF_PAGE_HEIGHT, PdfLeftMargin = PDF_LEFT_MARGIN, PdfTopMargin = PDF_TOP_MARGIN, PdfLineSpacing = PDF_LINE_SPACING, PdfFontSize = PDF_FONT_SIZE):
+	# Same layout as the PDF page, greyscale, 1 mm = Scale px
+	Scale = Dpi / 25.4
+	Raster = numpy.full((round(PdfPageHeight * Scale), round(PdfPageWidth * Scale)), 255, dtype = numpy.uint8)
+	Left = round(PdfLeftMargin * Scale)
+	Top = round((PdfPageHeight - PdfTopMargin + (PdfLineSpacing * 5)) * Scale)
+	Width, Height = round(Page.shape[1] * PixelSize * Scale), round(Page.shape[0] * PixelSize * Scale)
+	Drawing = numpy.where(Page, 0, 255).astype(numpy.uint8)
+	Raster[Top : Top + Height, Left : Left + Width] = cv2.resize(Drawing, (Width, Height), interpolation = cv2.INTER_NEAREST)
+	# Captions: Hershey font, cap height of the PDF font
+	FontScale = (PdfFontSize * 0.6 / 72 * Dpi) / cv2.getTextSize('H', cv2.FONT_HERSHEY_SIMPLEX, 1, 1)[0][1]
+	for Line, Caption in enumerate(Captions):
+		Y = round((PdfPageHeight - PdfTopMargin + (PdfLineSpacing * (Line + 1))) * Scale)
+		cv2.putText(Raster, Caption, (Left, Y), cv2.FONT_HERSHEY_SIMPLEX, FontScale, 0, max(1, round(FontScale * 1.5)), cv2.LINE_8)
+	return Raster
+
+def CreateRaster(Dataset, PixelSheets, OutputFileName, JobName, Format = 'png', Dpi = RASTER_DPI, SpacingSize = SPACING_SIZE, PdfPageWidth = PDF_PAGE_WIDTH, PdfLeftMargin = PDF_LEFT_MARGIN, PdfRightMargin = PDF_RIGHT_MARGIN, Timestamp = None, Executor = None):
+	# One image per page: "out.png" -> "out-page-1.png", ...
+	PixelSize = PagePixelSize(PixelSheets, SpacingSize, PdfPageWidth, PdfLeftMargin, PdfRightMargin)
+	Stem = os.path.splitext(OutputFileName)[0]
+	Params = {
+		'png': [ cv2.IMWRITE_PNG_BILEVEL, 1 ],
+		'tiff': [ cv2.IMWRITE_TIFF_RESUNIT, 2, cv2.IMWRITE_TIFF_XDPI, Dpi, cv2.IMWRITE_TIFF_YDPI, Dpi ]
+		}[Format]
+	if Timestamp is None: Timestamp = CurrentTimestamp()
+	# Pages may be rasterized by the pool, they are written in order
+	Tasks = ({ 'Page': Page, 'PixelSize': PixelSize, 'Captions': CreateCaptions(Dataset, JobName, Timestamp, PageNumber, PixelSheets['PagesNumber']), 'Dpi': Dpi } for PageNumber, Page in enumerate(PixelSheets['Pages']))
+	for PageNumber, Raster in ProgressBar(enumerate(PoolMap(RasterizePage, Tasks, Executor)), total = PixelSheets['PagesNumber'], desc = f'Draw {Format.upper()} pages'):
+		with StageTimer('encode.image_write'): Written = cv2.imwrite(f'{Stem}-page-{PageNumber + 1}.{Format}', Raster, Params)
+		if not Written: raise RuntimeError(f'Cannot write "{Stem}-page-{PageNumber + 1}.{Format}"')
 
 
 # -----=====| ENCODE MAIN |=====-----
 
-def EncodeMain(JobName, InputFileName, OutputFileName, ColNum, RowNum):
+@StageTimer('encode.job')
+def EncodeMain(JobName, InputFileName, OutputFileName, ColNum, RowNum, SvgDir = None, Format = OUTPUT_FORMAT, Dpi = RASTER_DPI, ChunkSize = None, QRVersion = QR_VERSION, ErrorCorrection = QR_ERROR_CORRECTION, BlockFormat = BLOCK_FORMAT, Parity = PARITY_OVERHEAD, Compression = COMPRESSION, Jobs = ENCODE_JOBS, RunID = None, Timestamp = None):
 	logging.info(f'pawpyrus {__version__} Encoder')
 	logging.info(f'Job Name: {JobName}')
 	logging.info(f'Input File: "{os.path.realpath(InputFileName)}"')
 	logging.info(f'Output File: "{os.path.realpath(OutputFileName)}"')
-	# Read rawdata
-	RawData = open(InputFileName, 'rb').read()
-	# Create codes dataset
-	Dataset = CreateDataset(RawData)
-	logging.info(f'Run ID: {Dataset["RunID"]["hex"]}')
-	logging.info(f'SHA-256: {Dataset["Hash"]["hex"]}')
-	logging.info(f'Blocks: {Dataset["Length"]["int"]}')
-	# Create pixelsheets
-	Pages = CreatePixelSheets(Dataset['Codes'], ColNum, RowNum)
-	# Draw SVG
-	SvgPages = DrawSVG(Pages, ColNum)
-	# Draw PDF
-	CreatePDF(Dataset, SvgPages, OutputFileName, JobName)
+	if Format != 'pdf': logging.info(f'Output Format: {Format.upper()}, {Dpi} dpi')
+	if Jobs > 1: logging.info(f'Jobs: {Jobs}')
+	if SvgDir is not None:
+		logging.info(f'SVG Output Dir: "{os.path.realpath(SvgDir)}"')
+		os.mkdir(SvgDir)
+	with open(InputFileName, 'rb') as InputFile, (concurrent.futures.ProcessPoolExecutor(Jobs) if Jobs > 1 else contextlib.nullcontext()) as Executor:
+		# Create codes dataset
+		Dataset = CreateDataset(InputFile, ChunkSize, QRVersion, ErrorCorrection, BlockFormat, Parity, Compression, RunID)
+		logging.info(f'Run ID: {Dataset["RunID"]["hex"]}')
+		logging.info(f'SHA-256: {Dataset["Hash"]["hex"]}')
+		if Dataset['Compression'] != 'none': logging.info(f'Compression: {Dataset["Compression"]}, {Dataset["Size"]} -> {Dataset["StoredSize"]} bytes')
+		elif Compression != 'none': logging.info(f'Compression: none, data do not compress')
+		logging.info(f'Blocks: {Dataset["Length"]["int"]}')
+		logging.info(f'QR: version {Dataset["QRVersion"]}, chunk size {Dataset["ChunkSize"]}, block format {Dataset["BlockFormat"]}')
+		if Dataset['Parity']['ParityBlocks']: logging.info(f'Parity: {Dataset["Parity"]["Stripes"]} stripes, {Dataset["Parity"]["ParityBlocks"]} parity blocks each, {Dataset["Total"]} blocks total')
+		# Everything below is lazy: a page is read, drawn and written before the next one.
+		# Written PDF pages stay in memory, compressed, until the file is saved
+		# With a pool, pages are created and drawn a few at once, in worker processes, and put together in order
+		# Create pixelsheets
+		Pages = CreatePixelSheets(Dataset['Codes'], ColNum, RowNum, Length = Dataset['Total'], ChunkSize = Dataset['ChunkSize'], ErrorCorrection = Dataset['ErrorCorrection'], QRVersion = Dataset['QRVersion'], Executor = Executor)
+		# Layout is checked before anything is drawn
+		PagePixelSize(Pages)
+		# Draw SVG
+		if SvgDir is not None: Pages = ExportSVG(Pages, SvgDir)
+		# Draw PDF or images
+		if Format == 'pdf': CreatePDF(Dataset, Pages, OutputFileName, JobName, Timestamp = Timestamp, Executor = Executor)
+		else: CreateRaster(Dataset, Pages, OutputFileName, JobName, Format, Dpi, Timestamp = Timestamp, Executor = Executor)
 	logging.info(f'Job finished')
 
 
 # -----=====| EXTRACTION |=====-----
 
 def ExtractData(Line, RunIDBlockSize = RUNID_BLOCK_SIZE, IndexBlockSize = INDEX_BLOCK_SIZE):
+	if Line[:1] == BLOCK_MARKER: return ExtractBinaryData(Line, RunIDBlockSize, IndexBlockSize)
+	# Both fields are whole base64 quads, decoded at once
+	Tag = base64.b64decode(Line[: RunIDBlockSize + IndexBlockSize])
 	Result = {
-		'RunID': Base64ToHex(Line[: RunIDBlockSize]),
-		'Index': Base64ToInt(Line[RunIDBlockSize : RunIDBlockSize + IndexBlockSize]),
+		'RunID': Tag[: RunIDBlockSize * 6 // 8].hex(),
+		'Index': int.from_bytes(Tag[RunIDBlockSize * 6 // 8 :], 'big'),
 		'Content': Line[RunIDBlockSize + IndexBlockSize :]
 		}
 	return Result
 
+def ExtractBinaryData(Line, RunIDBlockSize = RUNID_BLOCK_SIZE, IndexBlockSize = INDEX_BLOCK_SIZE):
+	Raw = Base45Decode(Line[1:])
+	RunIDEnd = 1 + (RunIDBlockSize * 6 // 8)
+	IndexEnd = RunIDEnd + (IndexBlockSize * 6 // 8)
+	if len(Raw) < IndexEnd: raise ValueError(f'Block is too short')
+	if Raw[0] not in BLOCK_FORMATS[1:]: raise ValueError(f'Unknown block format: {Raw[0]}')
+	Result = {
+		'Format': Raw[0],
+		'RunID': Raw[1 : RunIDEnd].hex(),
+		'Index': int.from_bytes(Raw[RunIDEnd : IndexEnd], 'big'),
+		'Content': Scramble(Raw[IndexEnd :])
+		}
+	return Result
+
 def ExtractMetadata(Content, IndexBlockSize = INDEX_BLOCK_SIZE):
+	# Format 2 header is raw bytes
+	if isinstance(Content, bytes):
+		# Fields missing in older headers are zeros
+		Length, Size, Hash, QRVersion, ErrorCorrection, ChunkSize, Stripes, ParityBlocks, Compression = struct.unpack_from(HEADER_FORMAT, Content.ljust(struct.calcsize(HEADER_FORMAT), b'\0'))
+		return { 'Length': Length, 'Hash': Hash.hex(), 'QRVersion': QRVersion, 'ErrorCorrection': ErrorCorrection, 'ChunkSize': ChunkSize, 'Size': Size, 'Stripes': Stripes, 'ParityBlocks': ParityBlocks, 'Compression': Compression }
+	Raw = base64.b64decode(Content)
+	Tail = Raw[IndexBlockSize * 6 // 8 :]
 	Result = {
-		'Length': Base64ToInt(Content[: IndexBlockSize]),
-		'Hash': hex(Base64ToInt(Content[IndexBlockSize :]))[2:]
+		'Length': int.from_bytes(Raw[: IndexBlockSize * 6 // 8], 'big'),
+		'Hash': Tail[:32].hex(),
+		'QRVersion': None,
+		'ErrorCorrection': None,
+		'ChunkSize': None,
+		'Size': None,
+		'Stripes': 0,
+		'ParityBlocks': 0,
+		'Compression': 0
 		}
+	# QR parameters, absent in older headers
+	if len(Tail) >= 36: Result['QRVersion'], Result['ErrorCorrection'], Result['ChunkSize'] = struct.unpack('>BBH', Tail[32:36])
 	return Result
 
-def DecodeQR(Barcode):
-	Result = { 'Contents': None, 'Detected': { } }
-	# pyzbar
+@functools.lru_cache(maxsize = None)
+def QRDetector():
+	# One detector per process
+	return cv2.QRCodeDetector()
+
+def DecodePyzbar(Barcode):
 	Code = decode(Barcode)
-	if Code:
-		Result['Contents'] = str(Code[0].data.decode('ascii'))
-		Result['Detected']['pyzbar'] = True
-	else: Result['Detected']['pyzbar'] = False
-	# opencv
-	detector = cv2.QRCodeDetector()
-	Code = detector.detectAndDecode(Barcode)[0]
-	if Code:
-		if Result['Contents'] is not None: assert Result['Contents'] == Code, f'Different results with different QR decoders? 1 = {Code}, 2 = {Result["Contents"]})?'
-		else: Result['Contents'] = str(Code)
-		Result['Detected']['opencv'] = True
-	else: Result['Detected']['opencv'] = False
+	return str(Code[0].data.decode('ascii')) if Code else None
+
+def DecodeOpenCV(Barcode):
+	Code = QRDetector().detectAndDecode(Barcode)[0]
+	return str(Code) if Code else None
+
+def ThresholdCell(Gray):
+	# Local threshold survives uneven lighting and stains
+	BlockSize = max(3, (min(Gray.shape[:2]) // 8) | 1)
+	return cv2.adaptiveThreshold(Gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, BlockSize, 2)
+
+def DeskewCell(Gray):
+	# Rotate by the angle of the dark pixels bounding box
+	Points = cv2.findNonZero(cv2.threshold(Gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1])
+	if Points is None: return Gray
+	Angle = cv2.minAreaRect(Points)[2]
+	if Angle > 45: Angle -= 90
+	Height, Width = Gray.shape[:2]
+	Matrix = cv2.getRotationMatrix2D((Width / 2, Height / 2), Angle, 1.0)
+	return cv2.warpAffine(Gray, Matrix, (Width, Height), flags = cv2.INTER_LINEAR, borderValue = 255)
+
+def UpscaleCell(Gray):
+	# Small modules are smoothed by interpolation, then binarized again
+	Upscaled = cv2.resize(Gray, None, fx = 2, fy = 2, interpolation = cv2.INTER_CUBIC)
+	return cv2.threshold(Upscaled, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+
+DECODERS = { 'pyzbar': DecodePyzbar, 'opencv': DecodeOpenCV }
+PREPROCESSING = { 'threshold': ThresholdCell, 'deskew': DeskewCell, 'upscale': UpscaleCell }
+
+def DecodeQR(Barcode, Gray = None, Decoders = QR_DECODERS, Retries = DECODE_RETRIES, CrossCheck = False):
+	# Decoders go in order and stop at the first success, unless cross-check is asked
+	Result = { 'Contents': None, 'Detected': { }, 'Stage': None, 'Timings': { Name: 0.0 for Name in Decoders }, 'Calls': { Name: 0 for Name in Decoders } }
+	# Hard cells are retried with escalating preprocessing of the grayscale image
+	Stages = [ ('binary', Barcode) ] + ([ (Stage, None) for Stage in Retries ] if Gray is not None else [ ])
+	for Stage, Image in Stages:
+		if Image is None: Image = PREPROCESSING[Stage](Gray)
+		for Name in Decoders:
+			if (Result['Contents'] is not None) and (not CrossCheck): break
+			Start = time.perf_counter()
+			Code = DECODERS[Name](Image)
+			Result['Timings'][Name] += time.perf_counter() - Start
+			Result['Calls'][Name] += 1
+			Result['Detected'][Name] = Result['Detected'].get(Name, False) or bool(Code)
+			if Code:
+				if Result['Contents'] is not None: assert Result['Contents'] == Code, f'Different results with different QR decoders? 1 = {Code}, 2 = {Result["Contents"]})?'
+				else: Result['Contents'] = Code
+		if Result['Contents'] is not None:
+			Result['Stage'] = Stage
+			break
+	return Result
+
+def DetectionStatistics(AnnotatedBlocks, Decoders = QR_DECODERS, Retries = DECODE_RETRIES):
+	# Per-decoder success and time, per-stage success; decoders not called count as not detected.
+	# Keys of older versions keep their meaning: "total", "neither" and the pair counts are of recognized blocks
+	Detected = [ { Name: block['Detected'].get(Name, False) for Name in Decoders } for block in AnnotatedBlocks ]
+	Recognized = [ item for item, block in zip(Detected, AnnotatedBlocks) if block['Contents'] is not None ]
+	Result = {
+		'total': len(Recognized),
+		'neither': [not any(item.values()) for item in Recognized].count(True),
+		'cells': len(AnnotatedBlocks),
+		'recognized': len(Recognized),
+		'unrecognized': len(AnnotatedBlocks) - len(Recognized),
+		'decoders': {
+			Name: {
+				'calls': sum(block['Calls'].get(Name, 0) for block in AnnotatedBlocks),
+				'cells': [Name in block['Detected'] for block in AnnotatedBlocks].count(True),
+				'detected': [item[Name] for item in Detected].count(True),
+				'only': [item[Name] and ([Value for Value in item.values()].count(True) == 1) for item in Detected].count(True),
+				'seconds': round(sum(block['Timings'].get(Name, 0.0) for block in AnnotatedBlocks), 4)
+				} for Name in Decoders
+			},
+		'stages': { Stage: [block['Stage'] == Stage for block in AnnotatedBlocks].count(True) for Stage in ('binary', ) + tuple(Retries) }
+		}
+	if set(Decoders) == { 'pyzbar', 'opencv' }:
+		Result['pyzbar_only'] = [item['pyzbar'] and not item['opencv'] for item in Recognized].count(True)
+		Result['opencv_only'] = [item['opencv'] and not item['pyzbar'] for item in Recognized].count(True)
+		Result['both'] = [item['pyzbar'] and item['opencv'] for item in Recognized].count(True)
 	return Result
 
 # -----=====| DETECT & DECODE |=====-----
 
-def ReadPage(FileName, DebugDir, FileIndex, ArUcoDictionary = ARUCO_DICTIONARY, MinMarkerPerimeterRate = MIN_MARKER_PERIMETER_RATE):
-	# Read and binarize image
-	Picture = cv2.imread(FileName, cv2.IMREAD_GRAYSCALE)
-	Threshold, Picture = cv2.threshold(Picture, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-	if DebugDir is not None: DebugArray = cv2.cvtColor(numpy.copy(Picture), cv2.COLOR_GRAY2RGB)
-	logging.info(f'Image binarized (threshold: {Threshold})')
-	# Detect markers
-	ArUcoDict = cv2.aruco.Dictionary_get(ArUcoDictionary)
+@StageTimer('decode.load_image')
+def LoadImage(Image):
+	# File name, encoded image (bytes or binary file object) or image array
+	if isinstance(Image, (str, os.PathLike)):
+		Picture = cv2.imread(os.fspath(Image), cv2.IMREAD_GRAYSCALE)
+		if Picture is None: raise RuntimeError(f'Cannot read image "{Image}"')
+		return Picture
+	if hasattr(Image, 'read'): Image = Image.read()
+	if isinstance(Image, (bytes, bytearray, memoryview)):
+		Picture = cv2.imdecode(numpy.frombuffer(Image, dtype = numpy.uint8), cv2.IMREAD_GRAYSCALE)
+		if Picture is None: raise RuntimeError(f'Cannot decode image')
+		return Picture
+	return cv2.cvtColor(Image, cv2.COLOR_BGR2GRAY) if Image.ndim == 3 else Image
+
+def IsPDF(Image):
+	# By signature; unreadable files are left for LoadImage to report
+	if isinstance(Image, (str, os.PathLike)):
+		try:
+			with open(Image, 'rb') as ImageFile: return ImageFile.read(len(PDF_SIGNATURE)) == PDF_SIGNATURE
+		except OSError:
+			return False
+	return isinstance(Image, (bytes, bytearray, memoryview)) and (bytes(Image[: len(PDF_SIGNATURE)]) == PDF_SIGNATURE)
+
+def MultiPageImage(FileName):
+	# Multi-page TIFF, one page decoded at a time
+	for Index in range(cv2.imcount(FileName)):
+		Success, Pages = cv2.imreadmulti(FileName, Index, 1, flags = cv2.IMREAD_GRAYSCALE)
+		if not Success: raise RuntimeError(f'Cannot read page {Index + 1} of "{FileName}"')
+		yield Pages[0]
+
+def IsTIFF(Image):
+	# In-memory images only, files are read by cv2
+	return isinstance(Image, (bytes, bytearray, memoryview)) and (bytes(Image[:4]) in TIFF_SIGNATURES)
+
+def OpenTIFF(Data):
+	# cv2 reads multi-page TIFF from files only, Pillow reads it from memory
+	try:
+		from PIL import Image as PILImage
+	except ImportError:
+		raise RuntimeError(f'Multi-page TIFF images in memory need Pillow: pip install pillow')
+	return PILImage.open(io.BytesIO(bytes(Data)))
+
+def TIFFPagesNumber(Data):
+	with OpenTIFF(Data) as Picture: return getattr(Picture, 'n_frames', 1)
+
+def MemoryTIFFPages(Data):
+	# Multi-page TIFF in memory, one page decoded at a time
+	with OpenTIFF(Data) as Picture:
+		for Index in range(Picture.n_frames):
+			Picture.seek(Index)
+			yield numpy.array(Picture.convert('L'))
+
+def PDFPages(Document, Dpi = PDF_SCAN_DPI):
+	# Scanned PDF, one page rendered at a time. pypdfium2 is needed for PDF input only
+	try:
+		import pypdfium2
+	except ImportError:
+		raise RuntimeError(f'PDF scans need pypdfium2: pip install pypdfium2')
+	PDF = pypdfium2.PdfDocument(os.fspath(Document) if isinstance(Document, (str, os.PathLike)) else bytes(Document))
+	try:
+		for Index in range(len(PDF)):
+			Page = PDF[Index]
+			Bitmap = Page.render(scale = Dpi / 72, grayscale = True)
+			# Copied out of the PDFium buffer, which is freed right away
+			Picture = numpy.array(Bitmap.to_numpy())
+			Bitmap.close()
+			Page.close()
+			yield Picture
+	finally:
+		PDF.close()
+
+def ScanPages(Images, Names = None, Dpi = PDF_SCAN_DPI):
+	# Name and image of every page; name is the file name if not given, None for in-memory images.
+	# Multi-page TIFF and PDF files are read lazily, page by page, their pages are named "file#1", "file#2", ...
+	for Image, Name in zip(Images, itertools.repeat(None) if Names is None else Names):
+		if (Name is None) and isinstance(Image, (str, os.PathLike)): Name = os.fspath(Image)
+		if hasattr(Image, 'read'): Image = Image.read()
+		if IsPDF(Image): Pages = PDFPages(Image, Dpi)
+		elif isinstance(Image, (str, os.PathLike)) and os.path.isfile(Image) and (cv2.imcount(os.fspath(Image)) > 1): Pages = MultiPageImage(os.fspath(Image))
+		elif IsTIFF(Image) and (TIFFPagesNumber(Image) > 1): Pages = MemoryTIFFPages(Image)
+		else:
+			yield Name, Image
+			continue
+		for Index, Page in enumerate(Pages): yield (None if Name is None else f'{Name}#{Index + 1}'), Page
+
+def MarkerCorners(Indices, CellSize, ColNum, RowNum, SpacingSize = SPACING_SIZE):
+	# Marker corners on the pixel sheet, clockwise from top left like detectMarkers returns them
+	Positions = MarkerPositions(CellSize, ColNum, RowNum, SpacingSize)
+	return numpy.array([ (Positions[Index][0] + DX, Positions[Index][1] + DY) for Index in Indices for DX, DY in ((0, 0), (SpacingSize, 0), (SpacingSize, SpacingSize), (0, SpacingSize)) ], dtype = numpy.float64)
+
+def FitTransform(Expected, Detected):
+	# Perspective needs the fourth corner marker, otherwise it is guessed from marker shapes only: affine is safer
+	if len(Expected) > 16: return cv2.findHomography(Expected, Detected)[0]
+	Affine = numpy.linalg.lstsq(numpy.hstack([Expected, numpy.ones((len(Expected), 1))]), Detected, rcond = None)[0]
+	return numpy.vstack([Affine.T, [0, 0, 1]])
+
+def EstimateLayout(Points, SpacingSize = SPACING_SIZE):
+	# Layout by marker centers, like the old grid alignment; cell size is snapped to the nearest QR version
+	Centers = [ Points[Index * 4 : (Index + 1) * 4].mean(axis = 0) for Index in range(4) ]
+	CellLength = math.dist(Centers[0], Centers[3])
+	MarkerLength = numpy.linalg.norm(Points - numpy.roll(Points.reshape(-1, 4, 2), 1, axis = 1).reshape(-1, 2), axis = 1).mean()
+	Version = round(((CellLength / MarkerLength * SpacingSize) - SpacingSize - 17) / 4)
+	return (Version, round(math.dist(Centers[0], Centers[1]) / CellLength), round(math.dist(Centers[0], Centers[2]) / CellLength))
+
+def FitGrid(Markers, SpacingSize = SPACING_SIZE):
+	Indices = sorted(Markers.keys())
+	Detected = numpy.array([ Markers[Index]['Coords'] for Index in Indices ], dtype = numpy.float64).reshape(-1, 2)
+	Estimate = EstimateLayout(Detected, SpacingSize)
+	# Perspective distorts the estimate. With the fourth corner marker, nearby layouts are tried,
+	# and the estimate is repeated on the page rectified by the best one
+	Spread = 1 if len(Indices) > 4 else 0
+	for Iteration in range(3):
+		Result = None
+		for Version, Cols, Rows in itertools.product(*[ range(Value - Spread, Value + Spread + 1) for Value in Estimate ]):
+			if (not 1 <= Version <= 40) or (Cols < 2) or (Rows < 1): continue
+			CellSize = 17 + (4 * Version) + SpacingSize
+			Expected = MarkerCorners(Indices, CellSize, Cols, Rows, SpacingSize)
+			Transform = FitTransform(Expected, Detected)
+			if Transform is None: continue
+			Error = float(numpy.linalg.norm(cv2.perspectiveTransform(Expected[None], Transform)[0] - Detected, axis = 1).mean())
+			if (Result is None) or (Error < Result['Error']): Result = { 'CellSize': CellSize, 'ColNum': Cols, 'RowNum': Rows, 'Homography': Transform, 'Error': Error }
+		if Result is None: raise RuntimeError(f'Cannot fit page grid')
+		if not Spread: break
+		Rectified = cv2.perspectiveTransform(Detected[None], numpy.linalg.inv(Result['Homography']))[0]
+		if EstimateLayout(Rectified, SpacingSize) == Estimate: break
+		Estimate = EstimateLayout(Rectified, SpacingSize)
+	# Rectified image resolution: marker pixel size
+	Result['Scale'] = numpy.linalg.norm(Detected - numpy.roll(Detected.reshape(-1, 4, 2), 1, axis = 1).reshape(-1, 2), axis = 1).mean() / SpacingSize
+	return Result
+
+@functools.lru_cache(maxsize = None)
+def ArUcoDetector(ArUcoDictionary = ARUCO_DICTIONARY, MinMarkerPerimeterRate = MIN_MARKER_PERIMETER_RATE, ThresholdWindow = None, PixelsPerBit = None):
+	# Dictionary and parameters are created once per process
 	ArUcoParams = cv2.aruco.DetectorParameters_create()
 	ArUcoParams.minMarkerPerimeterRate = MinMarkerPerimeterRate
-	Markers = cv2.aruco.detectMarkers(Picture, ArUcoDict, parameters = ArUcoParams)
+	# Pictures are binarized already: one adaptive threshold window instead of three is enough
+	if ThresholdWindow is not None: ArUcoParams.adaptiveThreshWinSizeMin = ArUcoParams.adaptiveThreshWinSizeMax = ThresholdWindow
+	# Small markers are read more reliably with more pixels per bit
+	if PixelsPerBit is not None: ArUcoParams.perspectiveRemovePixelPerCell = PixelsPerBit
+	return cv2.aruco.Dictionary_get(ArUcoDictionary), ArUcoParams
+
+def DetectMarkers(Picture, ArUcoDictionary = ARUCO_DICTIONARY, MinMarkerPerimeterRate = MIN_MARKER_PERIMETER_RATE, ThresholdWindow = None, PixelsPerBit = None):
+	# Marker ID to corners, clockwise from top left
+	ArUcoDict, ArUcoParams = ArUcoDetector(ArUcoDictionary, MinMarkerPerimeterRate, ThresholdWindow, PixelsPerBit)
+	Corners, IDs = cv2.aruco.detectMarkers(Picture, ArUcoDict, parameters = ArUcoParams)[:2]
+	return dict() if IDs is None else { int(ID[0]): Coords[0].astype(numpy.float64) for Coords, ID in zip(Corners, IDs) }
+
+def RefineMarker(Gray, Index, Corners, Margin = MARKER_REFINE_MARGIN, ArUcoDictionary = ARUCO_DICTIONARY):
+	# Marker is detected again at full resolution in a small region around the rough corners, binarized locally
+	Side = numpy.linalg.norm(Corners - numpy.roll(Corners, 1, axis = 0), axis = 1).mean()
+	Start = numpy.maximum(numpy.floor(Corners.min(axis = 0) - (Side * Margin)), 0).astype(int)
+	End = numpy.minimum(numpy.ceil(Corners.max(axis = 0) + (Side * Margin)), Gray.shape[::-1]).astype(int)
+	if (End <= Start).any(): return None
+	Region = cv2.threshold(Gray[Start[1] : End[1], Start[0] : End[0]], 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+	Found = DetectMarkers(Region, ArUcoDictionary, REFINE_MIN_MARKER_PERIMETER_RATE, MARKER_THRESHOLD_WINDOW)
+	return (Found[Index] + Start) if Index in Found else None
+
+def LocateMarkers(Gray, ArUcoDictionary = ARUCO_DICTIONARY, SearchSize = MARKER_SEARCH_SIZE, MinMarkerPerimeterRate = COARSE_MIN_MARKER_PERIMETER_RATE):
+	# Coarse to fine: markers are found on a downscaled copy, then refined at full resolution.
+	# None if corner markers are not found, full resolution search is the fallback
+	Factor = min(1.0, SearchSize / max(Gray.shape))
+	Small = cv2.resize(Gray, None, fx = Factor, fy = Factor, interpolation = cv2.INTER_AREA) if Factor < 1.0 else Gray
+	Picture = cv2.threshold(Small, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+	Coarse = { Index: Corners / Factor for Index, Corners in DetectMarkers(Picture, ArUcoDictionary, MinMarkerPerimeterRate, MARKER_THRESHOLD_WINDOW, MARKER_PIXELS_PER_BIT).items() }
+	if not { 0, 1, 2, 3 } <= set(Coarse.keys()): return None
+	Markers = dict()
+	for Index, Corners in Coarse.items():
+		Refined = RefineMarker(Gray, Index, Corners, ArUcoDictionary = ArUcoDictionary)
+		Markers[Index] = Corners if Refined is None else Refined
+	# Missed fifth marker is looked for where the parallelogram of the others puts it, two spacings below the last column
+	if 4 not in Markers:
+		Predicted = Markers[1] + Markers[2] - Markers[0] + (2 * (Markers[0][3] - Markers[0][0]))
+		Refined = RefineMarker(Gray, 4, Predicted, MARKER_PREDICT_MARGIN, ArUcoDictionary)
+		if Refined is not None: Markers[4] = Refined
+	return Markers
+
+def DetectPage(Image, DebugDir, ArUcoDictionary = ARUCO_DICTIONARY, MinMarkerPerimeterRate = MIN_MARKER_PERIMETER_RATE, SpacingSize = SPACING_SIZE, Localization = LOCALIZATION):
+	# Create output struct
+	Result = { 'Chunks': list(), 'DebugArray': None }
+	Gray = LoadImage(Image)
+	Markers, Picture = None, Gray
+	# Detect markers
+	if Localization == 'coarse':
+		with StageTimer('decode.markers'): Markers = LocateMarkers(Gray, ArUcoDictionary)
+		if Markers is None: logging.info(f'Markers not found on downscaled image, searching at full resolution')
+	if Markers is None:
+		# Binarize image
+		with StageTimer('decode.binarize'): Threshold, Picture = cv2.threshold(Gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+		logging.info(f'Image binarized (threshold: {Threshold})')
+		with StageTimer('decode.markers'): Markers = DetectMarkers(Picture, ArUcoDictionary, MinMarkerPerimeterRate)
 	# Check markers
-	if Markers is None: raise RuntimeError('No markers were found')
+	if not Markers: raise RuntimeError('No markers were found')
 	if DebugDir is not None:
-		for item in range(len(Markers[1])):
+		Result['DebugArray'] = cv2.cvtColor(numpy.copy(Picture), cv2.COLOR_GRAY2RGB)
+		for Index, Corners in Markers.items():
 			for LineStart, LineEnd in ((0, 1), (1, 2), (2, 3), (3, 0)):
 				cv2.line(
-					DebugArray,
-					tuple(int(i) for i in Markers[0][item][0][LineStart]),
-					tuple(int(i) for i in Markers[0][item][0][LineEnd]),
+					Result['DebugArray'],
+					tuple(int(i) for i in Corners[LineStart]),
+					tuple(int(i) for i in Corners[LineEnd]),
 					(255, 0, 0),
 					4
 				)
 			cv2.putText(
-				DebugArray,
-				f'id={Markers[1][item][0]}',
-				(int(Markers[0][item][0][0][0]), int(Markers[0][item][0][0][1]) - 20),
+				Result['DebugArray'],
+				f'id={Index}',
+				(int(Corners[0][0]), int(Corners[0][1]) - 20),
 				cv2.FONT_HERSHEY_SIMPLEX,
 				1.5,
 				(0, 255, 0),
 				4
 			)
-	Markers = { int(Markers[1][item][0]): {'Coords': Markers[0][item][0]} for item in range(len(Markers[1])) }
-	if tuple(sorted(Markers.keys())) != (0, 1, 2, 3): raise RuntimeError(f'Wrong markers or lack of markers')
-	# Align grid
-	MarkerLength = math.dist(Markers[0]['Coords'][0], Markers[0]['Coords'][1])
-	for item in Markers:
-		Markers[item]['Center'] = FindCenter(Markers[item]['Coords'])
-	Width = math.dist(Markers[0]['Center'], Markers[1]['Center'])
-	Height = math.dist(Markers[0]['Center'], Markers[2]['Center'])
-	CellSize = math.dist(Markers[0]['Center'], Markers[3]['Center'])
-	ColNum, RowNum = round(Width / CellSize), round(Height / CellSize)
-	logging.info(f'Layout detected: {ColNum} x {RowNum}')
-	CellSizeX, CellSizeY = Width / ColNum, Height / RowNum
-	VectorX = (
-		(Markers[1]['Center'][0] - Markers[0]['Center'][0]) / Width,
-		(Markers[1]['Center'][1] - Markers[0]['Center'][1]) / Width
-		)
-	VectorY = (
-		(Markers[2]['Center'][0] - Markers[0]['Center'][0]) / Height,
-		(Markers[2]['Center'][1] - Markers[0]['Center'][1]) / Height
-		)
-	for item in Markers:
-		Markers[item]['Center'] = (Markers[item]['Center'][0] + (MarkerLength * VectorX[0]), Markers[item]['Center'][1] + (MarkerLength * VectorY[1]))
-	# Chunking by grid
-	Chunks = list()
-	Cells = itertools.product(range(ColNum), range(RowNum))
-	for X, Y in Cells:
-		CoordStart = Markers[0]['Center']
-		FullVectorX = tuple(item * CellSizeX for item in VectorX)
-		FullVectorY = tuple(item * CellSizeY for item in VectorY)
-		Chunk = [
-			[
-				CoordStart[0] + (x * FullVectorX[0]) + (y * FullVectorY[0]),
-				CoordStart[1] + (x * FullVectorX[1]) + (y * FullVectorY[1])
-				]
-				for x, y in ((X, Y), (X + 1, Y), (X + 1, Y + 1), (X, Y + 1))
-			]
-		Xs, Ys = [x for x, y in Chunk], [y for x, y in Chunk]
-		Fragment = Picture[round(min(Ys)):round(max(Ys)), round(min(Xs)):round(max(Xs))]
-		Chunks.append({
+	Markers = { Index: {'Coords': Corners} for Index, Corners in Markers.items() }
+	if tuple(sorted(Markers.keys())) not in ((0, 1, 2, 3), (0, 1, 2, 3, 4)): raise RuntimeError(f'Wrong markers or lack of markers')
+	# Fit the page grid: layout and homography
+	with StageTimer('decode.fit_grid'): Grid = FitGrid(Markers)
+	logging.info(f'Layout detected: {Grid["ColNum"]} x {Grid["RowNum"]}, cell size {Grid["CellSize"]} (reprojection error: {Grid["Error"]:.2f} px)')
+	# Warp the page into grid coordinates once, cells are slices of it
+	Scale = Grid['Scale']
+	Transform = Grid['Homography'] @ numpy.diag([1 / Scale, 1 / Scale, 1])
+	Size = (math.ceil(((Grid['CellSize'] * Grid['ColNum']) + (SpacingSize * 2)) * Scale), math.ceil(((Grid['CellSize'] * Grid['RowNum']) + (SpacingSize * 2)) * Scale))
+	with StageTimer('decode.rectify'):
+		Rectified = cv2.warpPerspective(Gray, Transform, Size, flags = cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderValue = 255)
+		# Coarse mode binarizes every cell on its own, so shadows and uneven toner do not shift the threshold of the others
+		Binarized = cv2.threshold(Rectified, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1] if Localization == 'full' else None
+	# Cells: pawprint with half of spacing around
+	Cells = list(itertools.product(range(Grid['ColNum']), range(Grid['RowNum'])))
+	Origins = numpy.array(Cells, dtype = numpy.float64) * Grid['CellSize'] + (SpacingSize * 1.5)
+	Corners = numpy.array([(0, 0), (1, 0), (1, 1), (0, 1)], dtype = numpy.float64) * Grid['CellSize']
+	Coords = cv2.perspectiveTransform((Origins[:, None, :] + Corners[None, :, :]).reshape(1, -1, 2), Grid['Homography']).reshape(-1, 4, 2)
+	for (X, Y), (StartX, StartY), Chunk in zip(Cells, (Origins * Scale).round().astype(int), Coords):
+		Fragment = (slice(StartY, StartY + round(Grid['CellSize'] * Scale)), slice(StartX, StartX + round(Grid['CellSize'] * Scale)))
+		Result['Chunks'].append({
 			'Cell': (int(X) + 1, int(Y) + 1),
-			'Coords': Chunk,
-			'Image': Fragment
+			'Coords': Chunk.tolist(),
+			'Image': Binarized[Fragment] if Binarized is not None else cv2.threshold(Rectified[Fragment], 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1],
+			'Gray': Rectified[Fragment]
 			})
-	# Detect and decode
+	CountMetric('decode.pages')
+	return Result
+
+def DecodeCells(Page, Executor = None, Decoders = QR_DECODERS, Retries = DECODE_RETRIES, CrossCheck = False):
+	Images = [Chunk['Image'] for Chunk in Page['Chunks']]
+	Grays = [Chunk.get('Gray') for Chunk in Page['Chunks']]
+	Decoder = functools.partial(DecodeQR, Decoders = Decoders, Retries = Retries, CrossCheck = CrossCheck)
+	# Executor.map submits every cell at once and yields the results in submission order
+	return map(Decoder, Images, Grays) if Executor is None else Executor.map(Decoder, Images, Grays)
+
+def ObserveCell(Code):
+	# Cells may be decoded in worker processes, their timings come with the results
+	CountMetric('decode.cells')
+	if Code['Contents'] is not None: CountMetric(f'decode.cells_recognized.{Code["Stage"]}')
+	for Name, Seconds in Code['Timings'].items():
+		if Name in Code['Detected']: ObserveTime(f'decode.qr.{Name}', Seconds)
+
+def AnnotatePage(Page, Decoded, DebugDir, FileIndex):
+	# Returns every cell, unrecognized ones with empty contents
 	Codes = list()
-	for Chunk in tqdm.tqdm(Chunks, total = len(Chunks), desc = f'Detect QR codes', ascii = TQDM_STATUSBAR_ASCII):
-		Code = DecodeQR(Chunk['Image'])
-		if Code['Contents'] is not None:
-			Color = (0, 255, 0)
-			Codes.append(Code)
-		else: Color = (0, 0, 255)
+	DebugArray = Page['DebugArray']
+	Start = time.perf_counter()
+	for Chunk, Code in ProgressBar(zip(Page['Chunks'], Decoded), total = len(Page['Chunks']), desc = f'Detect QR codes'):
+		Codes.append(Code)
+		ObserveCell(Code)
+		Color = (0, 255, 0) if Code['Contents'] is not None else (0, 0, 255)
 		if DebugDir is not None:
-			if not Code: cv2.imwrite(os.path.join(DebugDir, f'unrecognized.page-{FileIndex}.x-{Chunk["Cell"][0]}.y-{Chunk["Cell"][1]}.jpg'), Chunk['Image'])
+			if Code['Contents'] is None: cv2.imwrite(os.path.join(DebugDir, f'unrecognized.page-{FileIndex}.x-{Chunk["Cell"][0]}.y-{Chunk["Cell"][1]}.jpg'), Chunk['Image'])
 			for LineStart, LineEnd in ((0, 1), (1, 2), (2, 3), (3, 0)):
 				cv2.line(
 					DebugArray,
@@ -376,11 +1175,28 @@ def ReadPage(FileName, DebugDir, FileIndex, ArUcoDictionary = ARUCO_DICTIONARY,
 				Color,
 				4
 			)
+	ObserveTime('decode.page_cells', time.perf_counter() - Start)
 	if DebugDir is not None: cv2.imwrite(os.path.join(DebugDir, f'page-{FileIndex}.jpg'), DebugArray)
 	return Codes
 
+def DetectAndDecode(Image, DebugDir = None, Decoders = QR_DECODERS, Retries = DECODE_RETRIES, CrossCheck = False, Localization = LOCALIZATION):
+	# Whole page in one call, so pages may be read by the pool: cells are decoded here, one by one.
+	# Cell images are sent back for debug output only
+	Page = DetectPage(Image, DebugDir, Localization = Localization)
+	Decoded = list(DecodeCells(Page, None, Decoders, Retries, CrossCheck))
+	if DebugDir is None: Page['Chunks'] = [ { 'Cell': Chunk['Cell'], 'Coords': Chunk['Coords'] } for Chunk in Page['Chunks'] ]
+	return Page, Decoded
+
+def ReadPage(FileName, DebugDir, FileIndex, ArUcoDictionary = ARUCO_DICTIONARY, MinMarkerPerimeterRate = MIN_MARKER_PERIMETER_RATE, Jobs = DECODE_JOBS, Executor = None, Decoders = QR_DECODERS, Retries = DECODE_RETRIES, CrossCheck = False, Localization = LOCALIZATION):
+	# Single page, its cells are decoded by the pool. FileName may be an image array as well.
+	# Without Executor, Jobs > 1 starts a pool for this page only: callers reading many pages pass their own Executor, or use ReadPages.
+	# Recognized blocks only, as before; every cell is returned by AnnotatePage
+	Page = DetectPage(FileName, DebugDir, ArUcoDictionary = ArUcoDictionary, MinMarkerPerimeterRate = MinMarkerPerimeterRate, Localization = Localization)
+	with (concurrent.futures.ProcessPoolExecutor(Jobs) if (Executor is None) and (Jobs > 1) else contextlib.nullcontext(Executor)) as Pool:
+		return [ Code for Code in AnnotatePage(Page, DecodeCells(Page, Pool, Decoders, Retries, CrossCheck), DebugDir, FileIndex) if Code['Contents'] is not None ]
+
+@StageTimer('decode.verify')
 def VerifyAndDecode(QRBlocks):
-	Result = list()
 	# Extract blocks
 	Extracted = [ExtractData(Line) for Line in QRBlocks]
 	Extracted = { item['Index']: item for item in Extracted }
@@ -393,59 +1209,667 @@ def VerifyAndDecode(QRBlocks):
 	Metadata = ExtractMetadata(Header['Content'])
 	logging.info(f'Blocks: {Metadata["Length"]}')
 	logging.info(f'SHA-256: {Metadata["Hash"]}')
+	if Metadata['QRVersion'] is not None:
+		ErrorCorrectionLevel = { Value: Key for Key, Value in QR_ERROR_CORRECTION_LEVELS.items() }.get(Metadata['ErrorCorrection'], '?')
+		logging.info(f'QR: version {Metadata["QRVersion"]}, error correction {ErrorCorrectionLevel}, chunk size {Metadata["ChunkSize"]}')
+	BlockFormat = Header.get('Format', 1)
+	logging.info(f'Block format: {BlockFormat}')
+	if Metadata['ParityBlocks']: logging.info(f'Parity: {Metadata["Stripes"]} stripes, {Metadata["ParityBlocks"]} parity blocks each')
 	# Check blocks
-	MissingBlocks = list()
-	for Index in range(1, Metadata['Length']):
+	for Block in Extracted.values():
+		if (Block['RunID'] != Header['RunID']) or (Block.get('Format', 1) != BlockFormat): raise RuntimeError(f'Some blocks are not of this header')
+	MissingBlocks = [ Index for Index in range(1, Metadata['Length']) if Index not in Extracted ]
+	# Restore missing blocks from parity
+	if MissingBlocks and Metadata['ParityBlocks']:
+		with StageTimer('decode.parity_restore'): Restored = RecoverBlocks(Extracted, Metadata)
+		CountMetric('decode.blocks_restored', len(Restored))
+		logging.info(f'Blocks restored from parity: {len(Restored)} of {len(MissingBlocks)} missing')
+		Extracted.update({ Index: { 'Content': Content } for Index, Content in Restored.items() })
+		MissingBlocks = [ Index for Index in MissingBlocks if Index not in Restored ]
+	if MissingBlocks: raise RuntimeError(f'Some blocks are missing: {"; ".join([str(Index) for Index in MissingBlocks])}')
+	Result = [ Extracted[Index]['Content'] for Index in range(1, Metadata['Length']) ]
+	# Decode base64, format 2 blocks are raw bytes
+	ResultString = base64.b64decode(''.join(Result)) if BlockFormat == 1 else b''.join(Result)
+	# Decompress
+	Codecs = { Number: (Name, Decompressor) for Name, (Number, Compressor, Decompressor) in COMPRESSION_CODECS.items() }
+	if Metadata['Compression'] not in Codecs: raise RuntimeError(f'Unknown compression: {Metadata["Compression"]}')
+	if Metadata['Compression']:
+		logging.info(f'Compression: {Codecs[Metadata["Compression"]][0]}')
 		try:
-			Extracted[Index]
-			if Extracted[Index]['RunID'] != Header['RunID']: raise RuntimeError(f'Some blocks are not of this header')
-			Result.append(Extracted[Index]['Content'])
-		except KeyError:
-			MissingBlocks.append(str(Index))
-	if MissingBlocks: raise RuntimeError(f'Some blocks are missing: {"; ".join(MissingBlocks)}')
-	# Decode base64
-	ResultString = base64.b64decode(''.join(Result))
+			with StageTimer('decode.decompress'): ResultString = Codecs[Metadata['Compression']][1](ResultString)
+		except (zlib.error, lzma.LZMAError, OSError, ValueError) as Error:
+			raise RuntimeError(f'Data damaged (cannot decompress: {Error})')
 	# Check hashsum
 	if hashlib.sha256(ResultString).hexdigest() != Metadata['Hash']: raise RuntimeError(f'Data damaged (hashes are not the same)')
 	# Return
 	return ResultString
 
+def GroupBlocks(QRBlocks):
+	# Blocks by run ID, broken blocks are skipped
+	Result = dict()
+	for Line in QRBlocks:
+		try:
+			RunID = ExtractData(Line)['RunID']
+		except ValueError:
+			logging.warning(f'Block skipped, cannot extract data: {Line[:16]}...')
+			continue
+		Result.setdefault(RunID, list()).append(Line)
+	return Result
+
+def DecodeRuns(RunIDs, DecodeRun):
+	# Every run is verified on its own, a broken one does not stop the others
+	Result = dict()
+	for RunID in RunIDs:
+		logging.info(f'Run ID: {RunID}')
+		try:
+			Result[RunID] = { 'Data': DecodeRun(RunID), 'Error': None }
+		except (RuntimeError, ValueError) as Error:
+			logging.warning(f'Run ID {RunID} is not decoded: {Error}')
+			Result[RunID] = { 'Data': None, 'Error': str(Error) }
+	return Result
+
+def DemultiplexAndDecode(QRBlocks):
+	Groups = GroupBlocks(QRBlocks)
+	logging.info(f'Archives found: {len(Groups)}')
+	return DecodeRuns(Groups.keys(), lambda RunID: VerifyAndDecode(Groups[RunID]))
+
+def SaveRuns(Runs, OutputDir):
+	# One file per run, named by run ID
+	os.makedirs(OutputDir, exist_ok = True)
+	for RunID, Run in Runs.items():
+		if Run['Data'] is None: continue
+		with open(os.path.join(OutputDir, f'{RunID}.bin'), 'wb') as Out: Out.write(Run['Data'])
+		logging.info(f'Run ID {RunID}: {len(Run["Data"])} bytes saved')
+	Failed = [ RunID for RunID, Run in Runs.items() if Run['Data'] is None ]
+	if Failed: raise RuntimeError(f'Some archives are not decoded: {", ".join(Failed)}')
+
+
+def ReadPages(Images, DebugDir = None, Executor = None, Decoders = QR_DECODERS, Retries = DECODE_RETRIES, CrossCheck = False, Localization = LOCALIZATION):
+	# Yields annotated cells page by page.
+	# Whole pages are detected and decoded by the pool, a few at once; annotation and debug output go in order here
+	def Tasks():
+		for FileIndex, (Name, Image) in enumerate(ScanPages(Images)):
+			if Name is not None: logging.info(f'Proccesing "{Name}"')
+			else: logging.info(f'Proccesing page {FileIndex + 1}')
+			yield { 'Image': Image }
+	Reader = functools.partial(DetectAndDecode, DebugDir = DebugDir, Decoders = Decoders, Retries = Retries, CrossCheck = CrossCheck, Localization = Localization)
+	for FileIndex, (Page, Decoded) in enumerate(PoolMap(Reader, Tasks(), Executor)): yield AnnotatePage(Page, Decoded, DebugDir, FileIndex + 1)
+
 
 # -----=====| DECODE MAIN |=====-----
 
-def DecodeMain(ImageInput, TextInput, DebugDir, OutputFileName):
-	if (not ImageInput) and (TextInput is None): raise ValueError(f'Input is empty: no images, no text!')
+@StageTimer('decode.job')
+def DecodeMain(ImageInput, TextInput, DebugDir, OutputFileName, Jobs = DECODE_JOBS, Decoders = QR_DECODERS, Retries = DECODE_RETRIES, CrossCheck = False, SessionFileName = None, Demultiplex = False, Localization = LOCALIZATION):
+	if (not ImageInput) and (TextInput is None) and (SessionFileName is None): raise ValueError(f'Input is empty: no images, no text!')
 	logging.info(f'pawpyrus {__version__} Decoder')
 	if DebugDir is not None:
 		logging.info(f'DEBUG MODE ON')
 		os.mkdir(DebugDir)
 	if ImageInput: logging.info(f'Image Input File(s): "{", ".join([os.path.realpath(item) for item in ImageInput])}"')
 	if TextInput is not None: logging.info(f'Text Input File: "{os.path.realpath(TextInput)}"')
-	logging.info(f'Output File: "{os.path.realpath(OutputFileName)}"')
-	AnnotatedBlocks = list()
-	for FileIndex, FileName in enumerate(ImageInput):
-		logging.info(f'Proccesing "{FileName}"')
-		AnnotatedBlocks += ReadPage(FileName, DebugDir, FileIndex + 1)
-	if DebugDir is not None:
-		DetectionStatistics = {
-			'total': len(AnnotatedBlocks),
-			'pyzbar_only': [(not block['Detected']['opencv']) and block['Detected']['pyzbar'] for block in AnnotatedBlocks].count(True),
-			'opencv_only': [block['Detected']['opencv'] and (not block['Detected']['pyzbar']) for block in AnnotatedBlocks].count(True),
-			'both': [block['Detected']['opencv'] and block['Detected']['pyzbar'] for block in AnnotatedBlocks].count(True),
-			'neither': [(not block['Detected']['opencv']) and (not block['Detected']['pyzbar']) for block in AnnotatedBlocks].count(True)
-			}
-		json.dump(DetectionStatistics, open(os.path.join(DebugDir, 'detection_stats.json'), 'wt'), indent = 4)
-	Blocks = [block['Contents'] for block in AnnotatedBlocks]
-	if TextInput is not None:
-		with open(TextInput, 'rt') as TF: Blocks += [ Line[:-1] for Line in TF.readlines() if Line[:-1] != '\n' ]
-	if DebugDir is not None:
-		with open(os.path.join(DebugDir, 'blocks.txt'), 'wt') as BF: BF.write('\n'.join(Blocks))
-	Result = VerifyAndDecode(Blocks)
-	with open(OutputFileName, 'wb') as Out: Out.write(Result)
+	logging.info(f'Output {"Dir" if Demultiplex else "File"}: "{os.path.realpath(OutputFileName)}"')
+	if SessionFileName is not None: logging.info(f'Session File: "{os.path.realpath(SessionFileName)}"')
+	if Jobs > 1: logging.info(f'Jobs: {Jobs}')
+	logging.info(f'QR decoders: {", ".join(Decoders)}{" (cross-check)" if CrossCheck else ""}; retries: {", ".join(Retries) if Retries else "none"}')
+	with (concurrent.futures.ProcessPoolExecutor(Jobs) if Jobs > 1 else contextlib.nullcontext()) as Executor, (DecodeSession(SessionFileName, Decoder(Executor = Executor, Decoders = Decoders, Retries = Retries, CrossCheck = CrossCheck, DebugDir = DebugDir, Localization = Localization)) if SessionFileName is not None else contextlib.nullcontext()) as Session:
+		# In a session, images decoded by previous runs are skipped
+		if Session is None: AnnotatedBlocks = [ Block for Page in ReadPages(ImageInput or [], DebugDir, Executor, Decoders, Retries, CrossCheck, Localization) for Block in Page ]
+		else: AnnotatedBlocks = Session.AddImages(ImageInput or [])
+		if DebugDir is not None:
+			json.dump(DetectionStatistics(AnnotatedBlocks, Decoders, Retries), open(os.path.join(DebugDir, 'detection_stats.json'), 'wt'), indent = 4)
+		Blocks = [block['Contents'] for block in AnnotatedBlocks if block['Contents'] is not None]
+		if TextInput is not None:
+			with open(TextInput, 'rt') as TF: Blocks += [ Line[:-1] for Line in TF.readlines() if Line[:-1] != '\n' ]
+		if DebugDir is not None:
+			with open(os.path.join(DebugDir, 'blocks.txt'), 'wt') as BF: BF.write('\n'.join(Blocks))
+		if Demultiplex:
+			# Several archives: every one is saved to its own file
+			if Session is not None: Session.AddBlocks(Blocks)
+			SaveRuns(DemultiplexAndDecode(Blocks) if Session is None else Session.FinalizeAll(), OutputFileName)
+			Result = None
+		elif Session is None: Result = VerifyAndDecode(Blocks)
+		else:
+			Session.AddBlocks(Blocks)
+			Status = Session.Status()
+			logging.info(f'Session: {Status["Blocks"]} blocks from {Status["Images"]} images, run ID: {Status["RunID"]}')
+			if Status['Missing']: logging.info(f'Missing blocks: {len(Status["Missing"])}, unrecoverable: {len(Status["Unrecoverable"])}')
+			if Status['MissingPages']: logging.info(f'Pages to rescan: {", ".join([str(Page) for Page in Status["MissingPages"]])}')
+			Result = Session.Finalize()
+	if Result is not None:
+		with open(OutputFileName, 'wb') as Out: Out.write(Result)
 	logging.info(f'Job finished')
 
+
+# -----=====| SELF-TEST |=====-----
+
+def Throughput(Seconds, Bytes, Pages):
+	return {
+		'Seconds': round(Seconds, 4),
+		'MBps': round(Bytes / (1024 ** 2) / Seconds, 4) if Seconds else None,
+		'PagesPerSecond': round(Pages / Seconds, 4) if Seconds else None
+		}
+
+def SelfTestMain(InputFileName, Size, ColNum, RowNum, Dpi = RASTER_DPI, Jobs = DECODE_JOBS, ReportFileName = None, ChunkSize = None, QRVersion = QR_VERSION, ErrorCorrection = QR_ERROR_CORRECTION, BlockFormat = BLOCK_FORMAT, Parity = PARITY_OVERHEAD, Compression = COMPRESSION):
+	logging.info(f'pawpyrus {__version__} Self-Test')
+	if InputFileName is not None:
+		logging.info(f'Input File: "{os.path.realpath(InputFileName)}"')
+		with open(InputFileName, 'rb') as InputFile: RawData = InputFile.read()
+	else:
+		logging.info(f'Input: {Size} random bytes')
+		RawData = secrets.token_bytes(Size)
+	Report = { 'Input': { 'Bytes': len(RawData), 'Layout': [ColNum, RowNum], 'Dpi': Dpi, 'Jobs': Jobs }, 'Stages': dict(), 'Success': False }
+	Stopwatch = { 'Start': None }
+	def Measure(Stage, Pages):
+		# Time since the previous stage, stages are fully evaluated one after another
+		Seconds = time.perf_counter() - Stopwatch['Start']
+		Report['Stages'][Stage] = Throughput(Seconds, len(RawData), Pages)
+		logging.info(f'{Stage}: {Seconds:.3f} s, {Report["Stages"][Stage]["MBps"]} MB/s, {Report["Stages"][Stage]["PagesPerSecond"]} pages/s')
+		Stopwatch['Start'] = time.perf_counter()
+	with (concurrent.futures.ProcessPoolExecutor(Jobs) if Jobs > 1 else contextlib.nullcontext()) as Executor:
+		Stopwatch['Start'] = time.perf_counter()
+		# Encode
+		Dataset = CreateDataset(RawData, ChunkSize, QRVersion, ErrorCorrection, BlockFormat, Parity, Compression)
+		Report['Input'].update({ 'ChunkSize': Dataset['ChunkSize'], 'QRVersion': Dataset['QRVersion'], 'ErrorCorrection': ErrorCorrection, 'BlockFormat': BlockFormat, 'Parity': Dataset['Parity'], 'Compression': Dataset['Compression'], 'StoredBytes': Dataset['StoredSize'] })
+		Codes = list(Dataset['Codes'])
+		PixelSheets = CreatePixelSheets(Codes, ColNum, RowNum, ChunkSize = Dataset['ChunkSize'], ErrorCorrection = ErrorCorrection, QRVersion = Dataset['QRVersion'])
+		PagesNumber = PixelSheets['PagesNumber']
+		PixelSize = PagePixelSize(PixelSheets)
+		Measure('CreateDataset', PagesNumber)
+		Pages = list(PixelSheets['Pages'])
+		Measure('CreatePixelSheets', PagesNumber)
+		Timestamp = CurrentTimestamp()
+		Rasters = [ RasterizePage(Page, PixelSize, CreateCaptions(Dataset, 'Self-Test', Timestamp, PageNumber, PagesNumber), Dpi) for PageNumber, Page in enumerate(Pages) ]
+		Measure('RasterizePage', PagesNumber)
+		# Decode
+		Detected = list()
+		for Raster in Rasters:
+			try:
+				Detected.append(DetectPage(Raster, None))
+			except RuntimeError as Error:
+				logging.warning(f'Page not detected: {Error}')
+		Measure('DetectPage', PagesNumber)
+		AnnotatedBlocks = list()
+		for PageIndex, Page in enumerate(Detected): AnnotatedBlocks += [ block for block in AnnotatePage(Page, list(DecodeCells(Page, Executor)), None, PageIndex + 1) if block['Contents'] is not None ]
+		Measure('DecodeCells', PagesNumber)
+	Report['Blocks'] = {
+		'Total': len(Codes),
+		'Recognized': len(AnnotatedBlocks),
+		'Pages': PagesNumber,
+		'PagesDetected': len(Detected),
+		'BytesPerPage': (Dataset['ChunkSize'] * 3 // 4 if BlockFormat == 1 else Dataset['ChunkSize']) * ColNum * RowNum
+		}
+	logging.info(f'Blocks recognized: {len(AnnotatedBlocks)} of {len(Codes)}')
+	try:
+		Result = VerifyAndDecode([block['Contents'] for block in AnnotatedBlocks])
+		Measure('VerifyAndDecode', PagesNumber)
+		Report['Success'] = Result == RawData
+	except RuntimeError as Error:
+		Report['Error'] = str(Error)
+	if ReportFileName is not None:
+		with open(ReportFileName, 'wt') as ReportFile: json.dump(Report, ReportFile, indent = 4)
+	if not Report['Success']: raise RuntimeError(f'Self-test failed: {Report.get("Error", "decoded data differ from input")}')
+	logging.info(f'Self-test passed')
+	return Report
+
+# -----=====| BENCHMARK |=====-----
+
+def DegradePage(Raster, Blur = 0, Noise = 0, Rotation = 0, Perspective = 0, JpegQuality = None, Seed = 0):
+	# Scan or photo imitation: rotation (degrees), keystone (share of width), gaussian blur (sigma), noise (std), JPEG artefacts
+	Height, Width = Raster.shape
+	Image = Raster
+	if Rotation or Perspective:
+		Corners = numpy.float32([[0, 0], [Width, 0], [Width, Height], [0, Height]])
+		Transform = cv2.getPerspectiveTransform(Corners, Corners + numpy.float32([[Perspective * Width, 0], [-Perspective * Width, 0], [0, 0], [0, 0]]))
+		Transform = numpy.vstack([cv2.getRotationMatrix2D((Width / 2, Height / 2), Rotation, 1.0), [0, 0, 1]]) @ Transform
+		Image = cv2.warpPerspective(Image, Transform, (Width, Height), flags = cv2.INTER_LINEAR, borderValue = 255)
+	if Blur: Image = cv2.GaussianBlur(Image, (0, 0), Blur)
+	if Noise: Image = numpy.clip(Image + numpy.random.default_rng(Seed).normal(0, Noise, Image.shape), 0, 255).astype(numpy.uint8)
+	if JpegQuality is not None: Image = cv2.imdecode(cv2.imencode('.jpg', Image, [cv2.IMWRITE_JPEG_QUALITY, JpegQuality])[1], cv2.IMREAD_GRAYSCALE)
+	return Image
+
+def PeakMemory():
+	# Peak resident set size of the process, MB; not available on Windows
+	try:
+		import resource
+	except ImportError:
+		return None
+	return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def BenchmarkMain(Sizes = BENCHMARK_SIZES, Profiles = tuple(DEGRADATION_PROFILES.keys()), ColNum = COLUMNS_NUM, RowNum = ROWS_NUM, Dpi = RASTER_DPI, Jobs = DECODE_JOBS, ReportFileName = None, CorpusDir = None, ChunkSize = None, QRVersion = QR_VERSION, ErrorCorrection = QR_ERROR_CORRECTION, BlockFormat = BLOCK_FORMAT, Parity = PARITY_OVERHEAD, Compression = COMPRESSION, Localization = LOCALIZATION):
+	logging.info(f'pawpyrus {__version__} Benchmark')
+	logging.info(f'Sizes: {", ".join([str(Size) for Size in Sizes])}; degradation: {", ".join(Profiles)}')
+	if CorpusDir is not None: os.makedirs(CorpusDir, exist_ok = True)
+	Report = { 'Version': __version__, 'Input': { 'Layout': [ColNum, RowNum], 'Dpi': Dpi, 'Jobs': Jobs, 'ChunkSize': ChunkSize, 'QRVersion': QRVersion, 'ErrorCorrection': ErrorCorrection, 'BlockFormat': BlockFormat, 'Parity': Parity, 'Compression': Compression, 'Localization': Localization }, 'Runs': list() }
+	def Timed(Function, *Args):
+		Start = time.perf_counter()
+		Result = Function(*Args)
+		return Result, time.perf_counter() - Start
+	with (concurrent.futures.ProcessPoolExecutor(Jobs) if Jobs > 1 else contextlib.nullcontext()) as Executor:
+		for Size in Sizes:
+			# Random data: the worst case for compression-free storage, and the same for every run
+			RawData = numpy.random.default_rng(Size).integers(0, 256, Size, dtype = numpy.uint8).tobytes()
+			Run = { 'Bytes': Size, 'Pages': None, 'Encode': dict(), 'Decode': dict() }
+			# Stages are lazy, so every one is timed until fully evaluated
+			Dataset, Seconds = Timed(CreateDataset, RawData, ChunkSize, QRVersion, ErrorCorrection, BlockFormat, Parity, Compression)
+			Codes, Extra = Timed(list, Dataset['Codes'])
+			PixelSheets, Sheets = Timed(lambda: CreatePixelSheets(Codes, ColNum, RowNum, ChunkSize = Dataset['ChunkSize'], ErrorCorrection = ErrorCorrection, QRVersion = Dataset['QRVersion']))
+			Run['Pages'] = PixelSheets['PagesNumber']
+			Run['Encode']['CreateDataset'] = Throughput(Seconds + Extra, Size, Run['Pages'])
+			Pages, Seconds = Timed(lambda: list(PixelSheets['Pages']))
+			Run['Encode']['CreatePixelSheets'] = Throughput(Seconds + Sheets, Size, Run['Pages'])
+			Run['Encode']['DrawSVG'] = Throughput(Timed(lambda: list(DrawSVG(dict(PixelSheets, Pages = iter(Pages)), ColNum)))[1], Size, Run['Pages'])
+			Run['Encode']['CreatePDF'] = Throughput(Timed(CreatePDF, Dataset, dict(PixelSheets, Pages = iter(Pages)), io.BytesIO(), 'Benchmark')[1], Size, Run['Pages'])
+			PixelSize = PagePixelSize(PixelSheets)
+			Timestamp = CurrentTimestamp()
+			Rasters, Seconds = Timed(lambda: [ RasterizePage(Page, PixelSize, CreateCaptions(Dataset, 'Benchmark', Timestamp, PageNumber, Run['Pages']), Dpi) for PageNumber, Page in enumerate(Pages) ])
+			Run['Encode']['RasterizePage'] = Throughput(Seconds, Size, Run['Pages'])
+			for Profile in Profiles:
+				Images = [ DegradePage(Raster, **DEGRADATION_PROFILES[Profile], Seed = PageNumber) for PageNumber, Raster in enumerate(Rasters) ]
+				if CorpusDir is not None:
+					for PageNumber, Image in enumerate(Images): cv2.imwrite(os.path.join(CorpusDir, f'{Size}-{Profile}-page-{PageNumber + 1}.png'), Image)
+				# Lost pages count as unrecognized blocks
+				Blocks, PagesDetected = list(), 0
+				Start = time.perf_counter()
+				for PageNumber, Image in enumerate(Images):
+					try:
+						Blocks += [ Block['Contents'] for Block in ReadPage(Image, None, PageNumber + 1, Executor = Executor, Localization = Localization) ]
+						PagesDetected += 1
+					except RuntimeError as Error:
+						logging.warning(f'Page not detected: {Error}')
+				Decode = { 'ReadPage': Throughput(time.perf_counter() - Start, Size, Run['Pages']), 'PagesDetected': PagesDetected, 'Recognized': len(Blocks), 'Total': len(Codes), 'Success': False }
+				try:
+					Result, Seconds = Timed(VerifyAndDecode, Blocks)
+					Decode['VerifyAndDecode'] = Throughput(Seconds, Size, Run['Pages'])
+					Decode['Success'] = Result == RawData
+				except RuntimeError as Error:
+					Decode['Error'] = str(Error)
+				Run['Decode'][Profile] = Decode
+				logging.info(f'{Size} bytes, {Profile}: {len(Blocks)} of {len(Codes)} blocks, {Decode["ReadPage"]["PagesPerSecond"]} pages/s, {"success" if Decode["Success"] else "failure"}')
+			Run['PeakRSSMB'] = PeakMemory()
+			Report['Runs'].append(Run)
+	Decodes = [ Decode for Run in Report['Runs'] for Decode in Run['Decode'].values() ]
+	Report['SuccessRate'] = round([ Decode['Success'] for Decode in Decodes ].count(True) / len(Decodes), 4) if Decodes else None
+	Report['PeakRSSMB'] = PeakMemory()
+	logging.info(f'Success rate: {Report["SuccessRate"]}, peak RSS: {Report["PeakRSSMB"]} MB')
+	if ReportFileName is not None:
+		with open(ReportFileName, 'wt') as ReportFile: json.dump(Report, ReportFile, indent = 4)
+	return Report
+
+
+# -----=====| LIBRARY API |=====-----
+
+class PoolUser:
+	# Worker pool is either given or created on first use and kept until Close()
+
+	def __init__(self, Jobs, Executor):
+		self.Jobs = Jobs
+		self.Executor = Executor
+		self.OwnExecutor = False
+
+	def GetExecutor(self):
+		if (self.Executor is None) and (self.Jobs > 1):
+			self.Executor = concurrent.futures.ProcessPoolExecutor(self.Jobs)
+			self.OwnExecutor = True
+		return self.Executor
+
+	def Close(self):
+		if not self.OwnExecutor: return
+		self.Executor.shutdown()
+		self.Executor, self.OwnExecutor = None, False
+
+	def __enter__(self): return self
+
+	def __exit__(self, *Args): self.Close()
+
+class Encoder(PoolUser):
+	# Reusable encoder: data in (bytes or binary file object), PDF or page images out
+
+	def __init__(self, JobName = 'pawpyrus', ColNum = COLUMNS_NUM, RowNum = ROWS_NUM, ChunkSize = None, QRVersion = QR_VERSION, ErrorCorrection = QR_ERROR_CORRECTION, BlockFormat = BLOCK_FORMAT, Parity = PARITY_OVERHEAD, Compression = COMPRESSION, RunID = None, Timestamp = None, Jobs = ENCODE_JOBS, Executor = None):
+		self.JobName = JobName
+		self.ColNum = ColNum
+		self.RowNum = RowNum
+		self.ChunkSize = ChunkSize
+		self.QRVersion = QRVersion
+		self.ErrorCorrection = ErrorCorrection
+		self.BlockFormat = BlockFormat
+		self.Parity = Parity
+		self.Compression = Compression
+		# Pinned Run ID and timestamp make the output reproducible
+		self.RunID = RunID
+		self.Timestamp = Timestamp
+		super().__init__(Jobs, Executor)
+
+	def Dataset(self, Data):
+		# Dataset is created in two passes, so unseekable streams are read into memory
+		if hasattr(Data, 'seekable') and not Data.seekable(): Data = Data.read()
+		return CreateDataset(Data, self.ChunkSize, self.QRVersion, self.ErrorCorrection, self.BlockFormat, self.Parity, self.Compression, self.RunID)
+
+	def PixelSheets(self, Dataset): return CreatePixelSheets(Dataset['Codes'], self.ColNum, self.RowNum, Length = Dataset['Total'], ChunkSize = Dataset['ChunkSize'], ErrorCorrection = Dataset['ErrorCorrection'], QRVersion = Dataset['QRVersion'], Executor = self.GetExecutor())
+
+	def Encode(self, Data, Output = None, JobName = None):
+		# Output: file name or binary file object. PDF bytes are returned if there is none, dataset info otherwise
+		Dataset = self.Dataset(Data)
+		Buffer = io.BytesIO() if Output is None else Output
+		CreatePDF(Dataset, self.PixelSheets(Dataset), Buffer, self.JobName if JobName is None else JobName, Timestamp = self.Timestamp, Executor = self.GetExecutor())
+		return Buffer.getvalue() if Output is None else Dataset
+
+	def Rasterize(self, Data, Dpi = RASTER_DPI, JobName = None):
+		# Greyscale page images, one at a time
+		Dataset = self.Dataset(Data)
+		PixelSheets = self.PixelSheets(Dataset)
+		PixelSize = PagePixelSize(PixelSheets)
+		Timestamp = CurrentTimestamp() if self.Timestamp is None else self.Timestamp
+		Tasks = ({ 'Page': Page, 'PixelSize': PixelSize, 'Captions': CreateCaptions(Dataset, self.JobName if JobName is None else JobName, Timestamp, PageNumber, PixelSheets['PagesNumber']), 'Dpi': Dpi } for PageNumber, Page in enumerate(PixelSheets['Pages']))
+		yield from PoolMap(RasterizePage, Tasks, self.GetExecutor())
+
+class Decoder(PoolUser):
+	# Reusable decoder: images in (file names, encoded bytes, binary file objects or arrays), data out
+
+	def __init__(self, Jobs = DECODE_JOBS, Executor = None, Decoders = QR_DECODERS, Retries = DECODE_RETRIES, CrossCheck = False, DebugDir = None, Localization = LOCALIZATION):
+		super().__init__(Jobs, Executor)
+		self.Decoders = Decoders
+		self.Retries = Retries
+		self.CrossCheck = CrossCheck
+		self.DebugDir = DebugDir
+		self.Localization = Localization
+
+	def ReadPages(self, Images):
+		# Every cell with decoder details, page by page
+		if isinstance(Images, (str, os.PathLike, bytes, bytearray, memoryview, numpy.ndarray)) or hasattr(Images, 'read'): Images = [Images]
+		return ReadPages(Images, self.DebugDir, self.GetExecutor(), self.Decoders, self.Retries, self.CrossCheck, self.Localization)
+
+	def ReadBlocks(self, Images): return [ Block for Page in self.ReadPages(Images) for Block in Page ]
+
+	def Read(self, Images): return [ Block['Contents'] for Block in self.ReadBlocks(Images) if Block['Contents'] is not None ]
+
+	def Decode(self, Images = (), Blocks = ()):
+		# Blocks: QR contents gathered elsewhere, e.g. by earlier Read() calls
+		return VerifyAndDecode(self.Read(Images) + list(Blocks))
+
+	def DecodeAll(self, Images = (), Blocks = ()):
+		# Mixed archives: run ID -> { Data, Error }
+		return DemultiplexAndDecode(self.Read(Images) + list(Blocks))
+
+# -----=====| DECODE SESSION |=====-----
+
+def ImageKey(Image):
+	# Content hash of the image and the image itself, read into memory if it is a file
+	if isinstance(Image, (str, os.PathLike)):
+		with open(Image, 'rb') as ImageFile: Image = ImageFile.read()
+	elif hasattr(Image, 'read'): Image = Image.read()
+	if isinstance(Image, numpy.ndarray): return hashlib.sha256(str(Image.shape).encode('ascii') + Image.tobytes()).hexdigest(), Image
+	return hashlib.sha256(Image).hexdigest(), Image
+
+def BlockPosition(Index, Metadata):
+	# Place of the block in the printed sequence: every row of parity blocks follows a header copy
+	if Index < Metadata['Length']: return Index
+	Row, Stripe = divmod(Index - Metadata['Length'], Metadata['Stripes'])
+	return Metadata['Length'] + (Row * (Metadata['Stripes'] + 1)) + 1 + Stripe
+
+def UnrecoverableBlocks(Indices, Metadata):
+	# Missing data blocks which parity blocks at hand cannot restore
+	Missing = [ Index for Index in range(1, Metadata['Length']) if Index not in Indices ]
+	if not Metadata['ParityBlocks']: return Missing
+	Result = list()
+	for Stripe in range(Metadata['Stripes']):
+		StripeMissing = [ Index for Index in Missing if (Index - 1) % Metadata['Stripes'] == Stripe ]
+		Parity = [ Row for Row in range(Metadata['ParityBlocks']) if Metadata['Length'] + Stripe + (Row * Metadata['Stripes']) in Indices ]
+		if len(StripeMissing) > len(Parity): Result += StripeMissing
+	return sorted(Result)
+
+class DecodeSession:
+	# Decoded blocks kept in SQLite between runs: new scans add only their blocks, known images are skipped
+
+	def __init__(self, FileName, PageDecoder = None):
+		self.Decoder = Decoder() if PageDecoder is None else PageDecoder
+		self.Connection = sqlite3.connect(FileName)
+		self.Connection.execute('CREATE TABLE IF NOT EXISTS blocks (run_id TEXT, block_index INTEGER, contents TEXT NOT NULL, PRIMARY KEY (run_id, block_index))')
+		self.Connection.execute('CREATE TABLE IF NOT EXISTS images (hash TEXT PRIMARY KEY, name TEXT, cells INTEGER, blocks INTEGER)')
+		self.Connection.commit()
+
+	def StoreBlocks(self, Blocks):
+		# Broken blocks are skipped, repeated ones (e.g. header copies) are stored once
+		Rows = list()
+		for Line in Blocks:
+			try:
+				Extracted = ExtractData(Line)
+			except ValueError:
+				logging.warning(f'Block skipped, cannot extract data: {Line[:16]}...')
+				continue
+			Rows.append((Extracted['RunID'], Extracted['Index'], Line))
+		Before = self.Connection.total_changes
+		self.Connection.executemany('INSERT OR IGNORE INTO blocks VALUES (?, ?, ?)', Rows)
+		return self.Connection.total_changes - Before
+
+	def AddBlocks(self, Blocks):
+		# QR contents gathered elsewhere; returns the number of new blocks
+		Added = self.StoreBlocks(Blocks)
+		self.Connection.commit()
+		return Added
+
+	def AddImages(self, Images):
+		# Returns annotated cells of new images; every image is committed once decoded.
+		# Images are read lazily, pages of multi-page files are images of their own
+		Keys, Pending = set(), list()
+		def NewImages():
+			for Name, Image in ScanPages(Images):
+				Key, Contents = ImageKey(Image)
+				if (Key in Keys) or self.HasImage(Key):
+					logging.info(f'Image skipped, already decoded: {Name if Name is not None else Key}')
+					continue
+				Keys.add(Key)
+				Pending.append((Name, Key))
+				yield Contents
+		AnnotatedBlocks = list()
+		for Page in self.Decoder.ReadPages(NewImages()):
+			Name, Key = Pending.pop(0)
+			Added = self.AddPage(Key, Name, len(Page), [ Block['Contents'] for Block in Page if Block['Contents'] is not None ])
+			logging.info(f'New blocks: {Added}')
+			AnnotatedBlocks += Page
+		return AnnotatedBlocks
+
+	def HasImage(self, Key): return self.Connection.execute('SELECT 1 FROM images WHERE hash = ?', (Key,)).fetchone() is not None
+
+	def AddPage(self, Key, Name, Cells, Blocks):
+		# Page decoded elsewhere; returns the number of new blocks
+		Added = self.StoreBlocks(Blocks)
+		self.Connection.execute('INSERT OR IGNORE INTO images VALUES (?, ?, ?, ?)', (Key, Name, Cells, Added))
+		self.Connection.commit()
+		return Added
+
+	def RunIDs(self): return [ Row[0] for Row in self.Connection.execute('SELECT DISTINCT run_id FROM blocks ORDER BY run_id') ]
+
+	def Blocks(self, RunID): return [ Row[0] for Row in self.Connection.execute('SELECT contents FROM blocks WHERE run_id = ? ORDER BY block_index', (RunID,)) ]
+
+	def Status(self, RunID = None):
+		if RunID is None:
+			RunIDs = self.RunIDs()
+			if len(RunIDs) > 1: raise RuntimeError(f'Several archives in the session, run ID must be given: {", ".join(RunIDs)}')
+			RunID = RunIDs[0] if RunIDs else None
+		Indices = { Row[0] for Row in self.Connection.execute('SELECT block_index FROM blocks WHERE run_id = ?', (RunID,)) }
+		Images, PageCells = self.Connection.execute('SELECT COUNT(*), MAX(cells) FROM images').fetchone()
+		Result = { 'RunID': RunID, 'Blocks': len(Indices), 'Images': Images, 'Length': None, 'Missing': None, 'Unrecoverable': None, 'MissingPages': None, 'Complete': False }
+		if 0 not in Indices: return Result
+		Metadata = ExtractMetadata(ExtractData(self.Connection.execute('SELECT contents FROM blocks WHERE run_id = ? AND block_index = 0', (RunID,)).fetchone()[0])['Content'])
+		Result['Length'] = Metadata['Length']
+		Result['Missing'] = [ Index for Index in range(1, Metadata['Length']) if Index not in Indices ]
+		Result['Unrecoverable'] = UnrecoverableBlocks(Indices, Metadata)
+		# Pages are known only if scans were decoded in the session: the largest one is a full page
+		if PageCells: Result['MissingPages'] = sorted({ (BlockPosition(Index, Metadata) // PageCells) + 1 for Index in Result['Unrecoverable'] })
+		Result['Complete'] = not Result['Unrecoverable']
+		return Result
+
+	def Finalize(self, RunID = None):
+		Status = self.Status(RunID)
+		if Status['Length'] is None: raise RuntimeError(f'No root block in input data!')
+		if not Status['Complete']:
+			Pages = f'; pages to rescan: {", ".join([str(Page) for Page in Status["MissingPages"]])}' if Status['MissingPages'] else ''
+			raise RuntimeError(f'Some blocks are missing: {"; ".join([str(Index) for Index in Status["Unrecoverable"]])}{Pages}')
+		return VerifyAndDecode(self.Blocks(Status['RunID']))
+
+	def FinalizeAll(self): return DecodeRuns(self.RunIDs(), self.Finalize)
+
+	def Close(self): self.Connection.close()
+
+	def __enter__(self): return self
+
+	def __exit__(self, *Args): self.Close()
+
+# -----=====| SERVE |=====-----
+
+def ReadImage(Image, Decoders = QR_DECODERS, Retries = DECODE_RETRIES, CrossCheck = False, Localization = LOCALIZATION):
+	# One page in a worker: cells number and recognized contents
+	Page, Decoded = DetectAndDecode(Image, None, Decoders, Retries, CrossCheck, Localization)
+	for Code in Decoded: ObserveCell(Code)
+	return { 'Cells': len(Decoded), 'Blocks': [ Code['Contents'] for Code in Decoded if Code['Contents'] is not None ] }
+
+def EmitEvent(Event, Stream = None):
+	# Results are JSON lines, logging goes to stderr
+	Stream = sys.stdout if Stream is None else Stream
+	Stream.write(json.dumps(Event) + '\n')
+	Stream.flush()
+
+async def WatchInbox(InboxDir, Queue, Poll = SERVE_POLL_INTERVAL, Once = False):
+	# A file is taken when its size stays the same between two polls, so half-written scans are waited for
+	Sizes, Taken = dict(), set()
+	while True:
+		for Entry in sorted(os.scandir(InboxDir), key = lambda Entry: Entry.name):
+			if (not Entry.is_file()) or Entry.name.startswith('.') or (Entry.path in Taken): continue
+			Size = Entry.stat().st_size
+			if Once or (Sizes.get(Entry.path) == Size):
+				Taken.add(Entry.path)
+				await Queue.put({ 'Path': Entry.path })
+			else: Sizes[Entry.path] = Size
+		if Once: break
+		await asyncio.sleep(Poll)
+
+async def ReadRequests(Queue, Stream = None, EventStream = None):
+	# JSON lines: {"Path": "scan.jpg"} or {"Data": "<base64 of image file>", "Name": "scan"}
+	Stream = sys.stdin if Stream is None else Stream
+	Loop = asyncio.get_running_loop()
+	while True:
+		Line = await Loop.run_in_executor(None, Stream.readline)
+		if not Line: break
+		if not Line.strip(): continue
+		try:
+			Request = json.loads(Line)
+			if not (isinstance(Request, dict) and (('Path' in Request) or ('Data' in Request))): raise ValueError(f'Path or Data expected')
+			if not all(isinstance(Request[Key], str) for Key in ('Path', 'Data', 'Name') if Key in Request): raise ValueError(f'Path, Data and Name must be strings')
+		except ValueError as Error:
+			EmitEvent({ 'Event': 'Error', 'Name': None, 'Error': f'Wrong request: {Error}' }, EventStream)
+			continue
+		await Queue.put(Request)
+
+async def ServeMain(InboxDir, OutputDir, SessionFileName = None, Jobs = DECODE_JOBS, Poll = SERVE_POLL_INTERVAL, Once = False, Decoders = QR_DECODERS, Retries = DECODE_RETRIES, CrossCheck = False, Localization = LOCALIZATION, RequestStream = None, EventStream = None):
+	logging.info(f'pawpyrus {__version__} Decode Service')
+	logging.info(f'Input: {"stdin" if InboxDir is None else os.path.realpath(InboxDir)}')
+	logging.info(f'Output Dir: "{os.path.realpath(OutputDir)}"')
+	if SessionFileName is not None: logging.info(f'Session File: "{os.path.realpath(SessionFileName)}"')
+	os.makedirs(OutputDir, exist_ok = True)
+	Loop = asyncio.get_running_loop()
+	# Pages are decoded by the pool, session is written by the event loop only.
+	# The queue is bounded: input is not read faster than pages are decoded
+	Queue = asyncio.Queue(maxsize = Jobs * 2)
+	Reader = functools.partial(ReadImage, Decoders = Decoders, Retries = Retries, CrossCheck = CrossCheck, Localization = Localization)
+	Saved, InFlight = set(), set()
+	with (concurrent.futures.ProcessPoolExecutor(Jobs) if Jobs > 1 else concurrent.futures.ThreadPoolExecutor(1)) as Executor, DecodeSession(':memory:' if SessionFileName is None else SessionFileName) as Session:
+
+		def Report(RunID):
+			# Complete archives are saved once, others report what is missing
+			if RunID in Saved: return
+			Status = Session.Status(RunID)
+			if not Status['Complete']:
+				EmitEvent(dict({ 'Event': 'Status' }, **Status), EventStream)
+				return
+			Data = Session.Finalize(RunID)
+			FileName = os.path.join(OutputDir, f'{RunID}.bin')
+			with open(FileName, 'wb') as Out: Out.write(Data)
+			Saved.add(RunID)
+			logging.info(f'Run ID {RunID}: {len(Data)} bytes saved')
+			EmitEvent({ 'Event': 'Archive', 'RunID': RunID, 'Size': len(Data), 'Path': FileName }, EventStream)
+
+		def Scan(Request):
+			# Pages of multi-page files are reported one by one; reading, rendering and hashing are done off the event loop
+			Source = Request['Path'] if 'Path' in Request else base64.b64decode(Request['Data'])
+			for Name, Image in ScanPages([Source], [Request.get('Name', Request.get('Path'))]): yield (Name, ) + ImageKey(Image)
+
+		async def Process(Request):
+			Pages = Scan(Request)
+			while True:
+				Item = await Loop.run_in_executor(None, next, Pages, None)
+				if Item is None: break
+				Name, Key, Image = Item
+				# Images being decoded by other workers are not in the session yet
+				if Session.HasImage(Key) or (Key in InFlight):
+					EmitEvent({ 'Event': 'Skipped', 'Name': Name }, EventStream)
+					continue
+				InFlight.add(Key)
+				try:
+					# Metrics of the worker come back with the page
+					Page, Observations = await Loop.run_in_executor(Executor, functools.partial(CollectMetrics, Reader, Image = Image))
+					ReplayMetrics(Observations)
+					Added = Session.AddPage(Key, Name, Page['Cells'], Page['Blocks'])
+				finally:
+					InFlight.discard(Key)
+				EmitEvent({ 'Event': 'Image', 'Name': Name, 'Cells': Page['Cells'], 'Blocks': len(Page['Blocks']), 'NewBlocks': Added }, EventStream)
+				for RunID in GroupBlocks(Page['Blocks']): Report(RunID)
+
+		async def Worker():
+			while True:
+				Request = await Queue.get()
+				try:
+					if Request is None: return
+					await Process(Request)
+				except Exception as Error:
+					# Any failure is the request's own: the worker goes on, or the queue would fill up and block the input
+					if not isinstance(Error, (RuntimeError, ValueError, OSError)): logging.exception(f'Unexpected error')
+					logging.warning(f'Request failed: {Error}')
+					EmitEvent({ 'Event': 'Error', 'Name': Request.get('Name', Request.get('Path')), 'Error': f'{type(Error).__name__}: {Error}' }, EventStream)
+				finally:
+					Queue.task_done()
+
+		Workers = [ asyncio.create_task(Worker()) for Index in range(Jobs) ]
+		if InboxDir is None: await ReadRequests(Queue, RequestStream, EventStream)
+		else: await WatchInbox(InboxDir, Queue, Poll, Once)
+		for Index in range(Jobs): await Queue.put(None)
+		await asyncio.gather(*Workers)
+	logging.info(f'Service stopped')
+
 ## ------======| PARSER |======------
 
+def ChunkSizeType(Value): return None if Value == 'auto' else int(Value)
+
+def RunIDType(Value):
+	try:
+		RunID = int(Value, 16)
+	except ValueError:
+		raise argparse.ArgumentTypeError(f'not a hex number: {Value}')
+	if not 0 <= RunID < 2 ** (RUNID_BLOCK_SIZE * 6): raise argparse.ArgumentTypeError(f'must be {RUNID_BLOCK_SIZE * 6 // 4} hex digits at most: {Value}')
+	return RunID
+
+def TimestampType(Value): return str(datetime.datetime.fromisoformat(Value))
+
+def AddQRArguments(Parser):
+	Parser.add_argument('--qr-version', type = int, choices = range(1, 41), metavar = '{1..40}', default = QR_VERSION, dest = 'QRVersion', help = f'QR version. Default: the smallest one fitting the chunk size, or {QR_DEFAULT_VERSION} if the chunk size is auto')
+	Parser.add_argument('--error-correction', type = str, choices = QR_ERROR_CORRECTION_LEVELS.keys(), default = 'L', dest = 'ErrorCorrection', help = f'QR error correction level. Default = L')
+	Parser.add_argument('--chunk-size', type = ChunkSizeType, default = None, dest = 'ChunkSize', help = f'Data chunk size: bytes, or base64 chars in block format 1. "auto" fits the QR version. Default = auto')
+	Parser.add_argument('--block-format', type = int, choices = BLOCK_FORMATS, default = BLOCK_FORMAT, dest = 'BlockFormat', help = f'Block format: 1 is base64 text in QR byte mode, as in older printouts (not readable by older versions, though); 2 is base45 in QR alphanumeric mode, denser. Default = {BLOCK_FORMAT}')
+	Parser.add_argument('--parity', type = float, default = PARITY_OVERHEAD, dest = 'Parity', help = f'Parity blocks overhead, e.g. 0.1 adds 10%% blocks to restore lost ones. Block format 2 only. Default = {PARITY_OVERHEAD}')
+	Parser.add_argument('--compression', type = str, choices = COMPRESSION_MODES, default = COMPRESSION, dest = 'Compression', help = f'Compress data before encoding; "auto" takes the best codec, if any makes data smaller. Block format 2 only. Default = {COMPRESSION}')
+
+def AddMetricsArguments(Parser):
+	Parser.add_argument('--metrics', type = str, default = None, dest = 'MetricsFile', help = f'JSON file to save stage timers and counters.')
+	Parser.add_argument('--no-progress', action = 'store_true', dest = 'NoProgress', help = f'Do not show progress bars.')
+
+def AddLocalizationArgument(Parser):
+	Parser.add_argument('--localization', type = str, choices = LOCALIZATION_MODES, default = LOCALIZATION, dest = 'Localization', help = f'Page markers search. "coarse": on a downscaled image, refined at full resolution, cells binarized one by one; full resolution search if it fails. "full": full resolution only, the whole page binarized at once. Default = {LOCALIZATION}')
+
+def AddDecoderArguments(Parser):
+	Parser.add_argument('--decoders', nargs = '+', type = str, choices = DECODERS.keys(), default = QR_DECODERS, dest = 'Decoders', help = f'QR decoders, in order. The next one runs only if the previous ones fail. Default = {" ".join(QR_DECODERS)}')
+	Parser.add_argument('--cross-check', action = 'store_true', dest = 'CrossCheck', help = f'Run every decoder and compare the results.')
+	AddLocalizationArgument(Parser)
+	Parser.add_argument('--retries', nargs = '*', type = str, choices = PREPROCESSING.keys(), default = DECODE_RETRIES, dest = 'Retries', help = f'Preprocessing of unrecognized cells, in order. Nothing to disable. Default = {" ".join(DECODE_RETRIES)}')
+
 def CreateParser():
 	Default_parser = argparse.ArgumentParser(
 			formatter_class = argparse.RawDescriptionHelpFormatter,
@@ -461,35 +1885,159 @@ def CreateParser():
 	EncodeParser.add_argument('-o', '--output', required = True, type = str, dest = 'OutputFile', help = f'PDF file to save. Required.')
 	EncodeParser.add_argument('-c', '--cols', type = int, default = COLUMNS_NUM, dest = 'ColNum', help = f'Columns number. Default = {COLUMNS_NUM}')
 	EncodeParser.add_argument('-r', '--rows', type = int, default = ROWS_NUM, dest = 'RowNum', help = f'Rows number. Default = {ROWS_NUM}')
+	EncodeParser.add_argument('-s', '--svg-dir', type = str, default = None, dest = 'SvgDir', help = f'Directory where to save pages as SVG too.')
+	EncodeParser.add_argument('-f', '--format', type = str, choices = ['pdf', 'png', 'tiff'], default = OUTPUT_FORMAT, dest = 'Format', help = f'Output format. PNG and TIFF are written page by page: "out.png" -> "out-page-1.png", ... Default = {OUTPUT_FORMAT}')
+	EncodeParser.add_argument('--dpi', type = int, default = RASTER_DPI, dest = 'Dpi', help = f'Resolution of PNG and TIFF pages. Default = {RASTER_DPI}')
+	EncodeParser.add_argument('-j', '--jobs', type = int, default = ENCODE_JOBS, dest = 'Jobs', help = f'Number of worker processes creating and drawing pages. Output is the same for any number. Default = {ENCODE_JOBS}')
+	EncodeParser.add_argument('--run-id', type = RunIDType, default = None, dest = 'RunID', help = f'Run ID, {RUNID_BLOCK_SIZE * 6 // 4} hex digits. Default: random')
+	EncodeParser.add_argument('--timestamp', type = TimestampType, default = None, dest = 'Timestamp', help = f'Timestamp printed on pages, ISO format, e.g. "2022-08-07 12:00:00". Makes PDF output reproducible together with --run-id. Default: now')
+	AddQRArguments(EncodeParser)
+	AddMetricsArguments(EncodeParser)
 	# Decode parser
 	DecodeParser = Subparsers.add_parser('Decode', help=f'Decode data from paper storage scans')
-	DecodeParser.add_argument('-i', '--image', nargs = '*', type = str, dest = 'ImageInput', help = f'Paper storage scans to decode.')
+	DecodeParser.add_argument('-i', '--image', nargs = '*', type = str, dest = 'ImageInput', help = f'Paper storage scans to decode. Multi-page TIFF and PDF files are read page by page; PDF needs pypdfium2.')
 	DecodeParser.add_argument('-t', '--text', type = str, default = None, dest = 'TextInput', help = f'Files with lists of QR codes content, gathered manually.')
 	DecodeParser.add_argument('-o', '--output', required = True, type = str, dest = 'OutputFile', help = f'File to save decoded data. Required.')
 	DecodeParser.add_argument('-d', '--debug-dir', type = str, default = None, dest = 'DebugDir', help = f'Directory where to collect debug data if necessary.')
+	DecodeParser.add_argument('-j', '--jobs', type = int, default = DECODE_JOBS, dest = 'Jobs', help = f'Number of worker processes for QR decoding. Default = {DECODE_JOBS}')
+	AddDecoderArguments(DecodeParser)
+	DecodeParser.add_argument('-s', '--session', type = str, default = None, dest = 'SessionFile', help = f'SQLite file to keep decoded blocks between runs. Images decoded before are skipped, missing blocks and pages are reported.')
+	DecodeParser.add_argument('-m', '--demultiplex', action = 'store_true', dest = 'Demultiplex', help = f'Input holds several archives: decode every one, output is a directory with files named by run ID.')
+	AddMetricsArguments(DecodeParser)
+	# Serve parser
+	ServeParser = Subparsers.add_parser('Serve', help=f'Decode scans as they arrive, report results as JSON lines')
+	ServeInput = ServeParser.add_mutually_exclusive_group(required = True)
+	ServeInput.add_argument('-i', '--inbox', type = str, default = None, dest = 'InboxDir', help = f'Directory to watch for new scans.')
+	ServeInput.add_argument('--stdin', action = 'store_true', dest = 'Stdin', help = f'Read JSON lines from stdin: {{"Path": "scan.jpg"}} or {{"Data": "<base64 of image file>", "Name": "scan"}}.')
+	ServeParser.add_argument('-o', '--output', required = True, type = str, dest = 'OutputDir', help = f'Directory to save decoded archives, named by run ID. Required.')
+	ServeParser.add_argument('-s', '--session', type = str, default = None, dest = 'SessionFile', help = f'SQLite file to keep decoded blocks between runs. Default: in memory.')
+	ServeParser.add_argument('-j', '--jobs', type = int, default = DECODE_JOBS, dest = 'Jobs', help = f'Number of pages decoded at once, in worker processes if more than one. Default = {DECODE_JOBS}')
+	ServeParser.add_argument('--poll', type = float, default = SERVE_POLL_INTERVAL, dest = 'Poll', help = f'Inbox polling interval, seconds. Default = {SERVE_POLL_INTERVAL}')
+	ServeParser.add_argument('--once', action = 'store_true', dest = 'Once', help = f'Decode what is in the inbox and exit.')
+	AddDecoderArguments(ServeParser)
+	AddMetricsArguments(ServeParser)
+	# Benchmark parser
+	BenchmarkParser = Subparsers.add_parser('Benchmark', help=f'Measure encode and decode throughput on synthetic degraded scans')
+	BenchmarkParser.add_argument('-s', '--sizes', nargs = '+', type = int, default = BENCHMARK_SIZES, dest = 'Sizes', help = f'Input sizes, bytes of random data. Default = {" ".join([str(Size) for Size in BENCHMARK_SIZES])}')
+	BenchmarkParser.add_argument('-p', '--profiles', nargs = '+', type = str, choices = DEGRADATION_PROFILES.keys(), default = tuple(DEGRADATION_PROFILES.keys()), dest = 'Profiles', help = f'Degradation of rendered pages. Default: all')
+	BenchmarkParser.add_argument('-c', '--cols', type = int, default = COLUMNS_NUM, dest = 'ColNum', help = f'Columns number. Default = {COLUMNS_NUM}')
+	BenchmarkParser.add_argument('-r', '--rows', type = int, default = ROWS_NUM, dest = 'RowNum', help = f'Rows number. Default = {ROWS_NUM}')
+	BenchmarkParser.add_argument('--dpi', type = int, default = RASTER_DPI, dest = 'Dpi', help = f'Rasterization resolution. Default = {RASTER_DPI}')
+	BenchmarkParser.add_argument('-j', '--jobs', type = int, default = DECODE_JOBS, dest = 'Jobs', help = f'Number of worker processes for QR decoding. Default = {DECODE_JOBS}')
+	BenchmarkParser.add_argument('-o', '--report', type = str, default = None, dest = 'ReportFile', help = f'JSON file to save the report.')
+	BenchmarkParser.add_argument('--corpus-dir', type = str, default = None, dest = 'CorpusDir', help = f'Directory to save degraded pages as PNG.')
+	AddQRArguments(BenchmarkParser)
+	AddLocalizationArgument(BenchmarkParser)
+	AddMetricsArguments(BenchmarkParser)
+	# Self-test parser
+	SelfTestParser = Subparsers.add_parser('SelfTest', help=f'Encode, rasterize and decode in memory, report throughput')
+	SelfTestInput = SelfTestParser.add_mutually_exclusive_group(required = True)
+	SelfTestInput.add_argument('-i', '--input', type = str, default = None, dest = 'InputFile', help = f'File to encode.')
+	SelfTestInput.add_argument('-s', '--size', type = int, default = None, dest = 'Size', help = f'Encode this many random bytes.')
+	SelfTestParser.add_argument('-c', '--cols', type = int, default = COLUMNS_NUM, dest = 'ColNum', help = f'Columns number. Default = {COLUMNS_NUM}')
+	SelfTestParser.add_argument('-r', '--rows', type = int, default = ROWS_NUM, dest = 'RowNum', help = f'Rows number. Default = {ROWS_NUM}')
+	SelfTestParser.add_argument('--dpi', type = int, default = RASTER_DPI, dest = 'Dpi', help = f'Rasterization resolution. Default = {RASTER_DPI}')
+	SelfTestParser.add_argument('-j', '--jobs', type = int, default = DECODE_JOBS, dest = 'Jobs', help = f'Number of worker processes for QR decoding. Default = {DECODE_JOBS}')
+	SelfTestParser.add_argument('-o', '--report', type = str, default = None, dest = 'ReportFile', help = f'JSON file to save the report.')
+	AddQRArguments(SelfTestParser)
+	AddMetricsArguments(SelfTestParser)
 
 	return Default_parser
 
 # -----=====| MAIN |=====-----
 
-def main():
-	Parser = CreateParser()
-	Namespace = Parser.parse_args(sys.argv[1:])
+def RunCommand(Parser, Namespace):
 	if Namespace.command == 'Encode':
 		EncodeMain(
 			InputFileName = Namespace.InputFile,
 			JobName = Namespace.JobName,
 			OutputFileName = Namespace.OutputFile,
 			ColNum = Namespace.ColNum,
-			RowNum = Namespace.RowNum
+			RowNum = Namespace.RowNum,
+			SvgDir = Namespace.SvgDir,
+			Format = Namespace.Format,
+			Dpi = Namespace.Dpi,
+			ChunkSize = Namespace.ChunkSize,
+			QRVersion = Namespace.QRVersion,
+			ErrorCorrection = QR_ERROR_CORRECTION_LEVELS[Namespace.ErrorCorrection],
+			BlockFormat = Namespace.BlockFormat,
+			Parity = Namespace.Parity,
+			Compression = Namespace.Compression,
+			Jobs = Namespace.Jobs,
+			RunID = Namespace.RunID,
+			Timestamp = Namespace.Timestamp
 			)
 	elif Namespace.command == 'Decode':
 		DecodeMain(
 			ImageInput = Namespace.ImageInput,
 			TextInput = Namespace.TextInput,
 			DebugDir = Namespace.DebugDir,
-			OutputFileName = Namespace.OutputFile
+			OutputFileName = Namespace.OutputFile,
+			Jobs = Namespace.Jobs,
+			Decoders = Namespace.Decoders,
+			Retries = Namespace.Retries,
+			CrossCheck = Namespace.CrossCheck,
+			SessionFileName = Namespace.SessionFile,
+			Demultiplex = Namespace.Demultiplex,
+			Localization = Namespace.Localization
+			)
+	elif Namespace.command == 'Serve':
+		asyncio.run(ServeMain(
+			InboxDir = Namespace.InboxDir,
+			OutputDir = Namespace.OutputDir,
+			SessionFileName = Namespace.SessionFile,
+			Jobs = Namespace.Jobs,
+			Poll = Namespace.Poll,
+			Once = Namespace.Once,
+			Decoders = Namespace.Decoders,
+			Retries = Namespace.Retries,
+			CrossCheck = Namespace.CrossCheck,
+			Localization = Namespace.Localization
+			))
+	elif Namespace.command == 'Benchmark':
+		BenchmarkMain(
+			Sizes = Namespace.Sizes,
+			Profiles = Namespace.Profiles,
+			ColNum = Namespace.ColNum,
+			RowNum = Namespace.RowNum,
+			Dpi = Namespace.Dpi,
+			Jobs = Namespace.Jobs,
+			ReportFileName = Namespace.ReportFile,
+			CorpusDir = Namespace.CorpusDir,
+			ChunkSize = Namespace.ChunkSize,
+			QRVersion = Namespace.QRVersion,
+			ErrorCorrection = QR_ERROR_CORRECTION_LEVELS[Namespace.ErrorCorrection],
+			BlockFormat = Namespace.BlockFormat,
+			Parity = Namespace.Parity,
+			Compression = Namespace.Compression,
+			Localization = Namespace.Localization
+			)
+	elif Namespace.command == 'SelfTest':
+		SelfTestMain(
+			InputFileName = Namespace.InputFile,
+			Size = Namespace.Size,
+			ColNum = Namespace.ColNum,
+			RowNum = Namespace.RowNum,
+			Dpi = Namespace.Dpi,
+			Jobs = Namespace.Jobs,
+			ReportFileName = Namespace.ReportFile,
+			ChunkSize = Namespace.ChunkSize,
+			QRVersion = Namespace.QRVersion,
+			ErrorCorrection = QR_ERROR_CORRECTION_LEVELS[Namespace.ErrorCorrection],
+			BlockFormat = Namespace.BlockFormat,
+			Parity = Namespace.Parity,
+			Compression = Namespace.Compression
 			)
 	else: Parser.print_help()
 
+def main():
+	Parser = CreateParser()
+	Namespace = Parser.parse_args(sys.argv[1:])
+	METRICS['ProgressBars'] = not getattr(Namespace, 'NoProgress', False)
+	try:
+		RunCommand(Parser, Namespace)
+	finally:
+		# Metrics of failed jobs are saved as well
+		if getattr(Namespace, 'MetricsFile', None) is not None: SaveMetrics(Namespace.MetricsFile)
+
 if __name__ == '__main__': main()
@@ -1,5 +1,7 @@
+from more_itertools import sliced
 from pawpyrus import *
 import json
+import tempfile
 import unittest
 
 def HashJsonSerializable(Object): return hashlib.sha224(json.dumps(Object).encode('ascii')).hexdigest()
@@ -28,3 +30,359 @@ class TestKittyPawprint(unittest.TestCase):
 		Hash = HashJsonSerializable(Data)
 		Expected = 'bf1d0a1cd490c8731073a6b3409743683c59b9ec3c659f6a057e7c6b'
 		self.assertEqual(Hash, Expected)
+
+class TestDecodeCells(unittest.TestCase):
+
+	def test_DecodeCells_pool(self):
+		String = b'PxkGAAB1/Guy/5etlb0oIas6eoaMchEvv8D+aVyFo3agEowsX2VVjUMoTIEfWqsp/HBKboEV7awGCrO3X9eerwa/cR6Psq4vbEXJZWePEh8cHY8gEiLG'
+		Pawprint = TomcatPawprint(String, (4, 4))
+		Image = numpy.full((Pawprint['PawSize'] + 8, Pawprint['PawSize'] + 8), 255, dtype = numpy.uint8)
+		for X, Y in Pawprint['Pixels']: Image[Y, X] = 0
+		Image = cv2.resize(Image, None, fx = 8, fy = 8, interpolation = cv2.INTER_NEAREST)
+		Page = { 'Chunks': [ { 'Image': Image }, { 'Image': numpy.full((64, 64), 255, dtype = numpy.uint8) } ] }
+		Serial = list(DecodeCells(Page))
+		with concurrent.futures.ProcessPoolExecutor(2) as Executor: Parallel = list(DecodeCells(Page, Executor))
+		# Timings differ
+		for Result in Serial + Parallel: del Result['Timings']
+		self.assertEqual(Serial, Parallel)
+		self.assertEqual(Serial[0]['Contents'], String.decode('ascii'))
+		self.assertIsNone(Serial[1]['Contents'])
+
+class TestDecodeQR(unittest.TestCase):
+
+	def test_DecodeQR_cascade(self):
+		String = b'PxkGAAB1/Guy/5etlb0oIas6eoaMchEvv8D+aVyFo3agEowsX2VVjUMoTIEfWqsp/HBKboEV7awGCrO3X9eerwa/cR6Psq4vbEXJZWePEh8cHY8gEiLG'
+		Matrix = numpy.pad(TomcatMatrix(String, QRVersion = 6), 4)
+		Image = cv2.resize(numpy.where(Matrix, 0, 255).astype(numpy.uint8), None, fx = 8, fy = 8, interpolation = cv2.INTER_NEAREST)
+		# The second decoder is not called after the first one succeeds
+		Data = DecodeQR(Image)
+		self.assertEqual((Data['Contents'], Data['Detected'], Data['Stage']), (String.decode('ascii'), { 'pyzbar': True }, 'binary'))
+		Data = DecodeQR(Image, CrossCheck = True)
+		self.assertEqual(Data['Detected'], { 'pyzbar': True, 'opencv': True })
+		# Dim, low-contrast cell is recognized after preprocessing only
+		Blank = numpy.full(Image.shape, 255, dtype = numpy.uint8)
+		Data = DecodeQR(Blank, Gray = (Image // 4) + 100, Decoders = ('opencv', ), Retries = ('threshold', ))
+		self.assertEqual((Data['Contents'], Data['Stage']), (String.decode('ascii'), 'threshold'))
+
+class TestDetectPage(unittest.TestCase):
+
+	def test_DetectPage_perspective(self):
+		Dataset = CreateDataset(secrets.token_bytes(2000))
+		Codes = list(Dataset['Codes'])
+		PixelSheets = CreatePixelSheets(Codes, 6, 8, ChunkSize = Dataset['ChunkSize'], QRVersion = Dataset['QRVersion'])
+		Raster = RasterizePage(next(PixelSheets['Pages']), GetPixelSize(6, PixelSheets['CellSize']), [''] * 4)
+		# Photo taken at an angle: rotated page, top edge shorter than bottom one
+		Height, Width = Raster.shape
+		Corners = numpy.float32([[0, 0], [Width, 0], [Width, Height], [0, Height]])
+		Transform = cv2.getPerspectiveTransform(Corners, Corners + numpy.float32([[0.12 * Width, 0], [-0.12 * Width, 0], [0, 0], [0, 0]]))
+		Transform = numpy.vstack([cv2.getRotationMatrix2D((Width / 2, Height / 2), 3, 1.0), [0, 0, 1]]) @ Transform
+		Page = DetectPage(cv2.warpPerspective(Raster, Transform, (Width, Height), borderValue = 255), None)
+		Decoded = [ Code['Contents'] for Code in DecodeCells(Page, Retries = ()) if Code['Contents'] is not None ]
+		self.assertEqual(sorted(Decoded), sorted(Code.decode('ascii') for Code in Codes))
+
+	def test_DetectPage_coarse(self):
+		Raster = next(Encoder(ColNum = 4, RowNum = 4).Rasterize(secrets.token_bytes(1000), Dpi = 600))
+		Gray = DegradePage(Raster, **DEGRADATION_PROFILES['perspective'])
+		# Downscaled search with refinement finds every marker where full resolution search does
+		Coarse = LocateMarkers(Gray)
+		Full = DetectMarkers(cv2.threshold(Gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1])
+		self.assertEqual(sorted(Coarse.keys()), [0, 1, 2, 3, 4])
+		for Index, Corners in Full.items(): self.assertLess(numpy.abs(Coarse[Index] - Corners).max(), 3)
+		Cells = [ [ Code['Contents'] for Code in DecodeCells(DetectPage(Gray, None, Localization = Mode), Retries = ()) ] for Mode in LOCALIZATION_MODES ]
+		self.assertEqual(Cells[0], Cells[1])
+
+class TestEncoder(unittest.TestCase):
+
+	def test_Encoder_roundtrip(self):
+		Data = secrets.token_bytes(3000)
+		with Decoder(Retries = ()) as PageDecoder:
+			# Encoded images, arrays and previously read blocks are all accepted
+			Pages = list(Encoder(ColNum = 4, RowNum = 4).Rasterize(io.BytesIO(Data)))
+			Blocks = PageDecoder.Read(cv2.imencode('.png', Pages[0])[1].tobytes())
+			self.assertEqual(PageDecoder.Decode(Pages[1:], Blocks), Data)
+
+	def test_Encoder_pdf(self):
+		self.assertEqual(Encoder().Encode(b'pawpyrus')[:5], b'%PDF-')
+
+	def test_Encoder_jobs(self):
+		# Pages drawn by the pool are the same
+		Data = secrets.token_bytes(3000)
+		Options = { 'ColNum': 4, 'RowNum': 4, 'RunID': 1, 'Timestamp': '2022-08-07 12:00:00' }
+		with Encoder(Jobs = 2, **Options) as PageEncoder:
+			self.assertEqual(PageEncoder.Encode(Data), Encoder(**Options).Encode(Data))
+			for Page, Expected in zip(PageEncoder.Rasterize(Data), Encoder(**Options).Rasterize(Data)): self.assertTrue((Page == Expected).all())
+
+	def test_Encoder_layout(self):
+		# Too many rows run off the page: neither PDF nor images are drawn
+		with self.assertRaises(ValueError): Encoder(RowNum = 12).Encode(b'pawpyrus')
+		with self.assertRaises(ValueError): next(Encoder(RowNum = 12).Rasterize(b'pawpyrus'))
+
+class TestReadPage(unittest.TestCase):
+
+	def test_ReadPage_recognized(self):
+		# Empty cells are not returned, blocks go straight to VerifyAndDecode
+		Page = next(Encoder(ColNum = 4, RowNum = 4).Rasterize(b'pawpyrus'))
+		self.assertEqual(VerifyAndDecode([ Block['Contents'] for Block in ReadPage(Page, None, 1, Retries = ()) ]), b'pawpyrus')
+
+class TestDetectionStatistics(unittest.TestCase):
+
+	def test_DetectionStatistics_keys(self):
+		# Older keys count recognized blocks only
+		Blocks = [
+			{ 'Contents': 'A', 'Detected': { 'pyzbar': True }, 'Stage': 'binary', 'Timings': { 'pyzbar': 0.1, 'opencv': 0.0 }, 'Calls': { 'pyzbar': 1, 'opencv': 0 } },
+			{ 'Contents': 'B', 'Detected': { 'pyzbar': False, 'opencv': True }, 'Stage': 'binary', 'Timings': { 'pyzbar': 0.1, 'opencv': 0.1 }, 'Calls': { 'pyzbar': 1, 'opencv': 1 } },
+			{ 'Contents': None, 'Detected': { 'pyzbar': False, 'opencv': False }, 'Stage': None, 'Timings': { 'pyzbar': 0.1, 'opencv': 0.1 }, 'Calls': { 'pyzbar': 4, 'opencv': 4 } }
+			]
+		Result = DetectionStatistics(Blocks, ('pyzbar', 'opencv'), ())
+		self.assertEqual([ Result[Key] for Key in ('total', 'neither', 'pyzbar_only', 'opencv_only', 'both', 'cells', 'unrecognized') ], [2, 0, 1, 1, 0, 3, 1])
+		# Retries call decoders again
+		self.assertEqual((Result['decoders']['pyzbar']['calls'], Result['decoders']['pyzbar']['cells']), (6, 3))
+
+class TestEncodeMain(unittest.TestCase):
+
+	def test_EncodeMain_jobs(self):
+		# Pinned run ID and timestamp: the same bytes with and without the pool
+		with tempfile.TemporaryDirectory() as TempDir:
+			InputFileName = os.path.join(TempDir, 'input.bin')
+			with open(InputFileName, 'wb') as InputFile: InputFile.write(secrets.token_bytes(3000))
+			Outputs = []
+			for Jobs in (1, 2):
+				OutputFileName = os.path.join(TempDir, f'output-{Jobs}.pdf')
+				EncodeMain('pawpyrus', InputFileName, OutputFileName, 4, 4, Jobs = Jobs, RunID = 0x0a1b2c, Timestamp = '2022-08-07 12:00:00')
+				with open(OutputFileName, 'rb') as OutputFile: Outputs.append(OutputFile.read())
+			self.assertEqual(Outputs[0], Outputs[1])
+
+class TestRunIDType(unittest.TestCase):
+
+	def test_RunIDType_range(self):
+		self.assertEqual(RunIDType('0a1b2c'), 0x0a1b2c)
+		for Value in ('1000000', '-1', 'zz'):
+			with self.assertRaises(argparse.ArgumentTypeError): RunIDType(Value)
+
+class TestScanPages(unittest.TestCase):
+
+	def test_ScanPages_tiff(self):
+		Data = secrets.token_bytes(3000)
+		with tempfile.TemporaryDirectory() as TempDir:
+			FileName = os.path.join(TempDir, 'scan.tiff')
+			cv2.imwritemulti(FileName, list(Encoder(ColNum = 4, RowNum = 4).Rasterize(Data)))
+			self.assertEqual([ Name for Name, Page in ScanPages([FileName]) ], [f'{FileName}#1', f'{FileName}#2'])
+			self.assertEqual(Decoder(Retries = ()).Decode(FileName), Data)
+			# In memory, as file contents or file object
+			with open(FileName, 'rb') as ScanFile: self.assertEqual(Decoder(Retries = ()).Decode(ScanFile.read()), Data)
+			with open(FileName, 'rb') as ScanFile: self.assertEqual(Decoder(Retries = ()).Decode(ScanFile), Data)
+
+	def test_ScanPages_pdf(self):
+		try:
+			import pypdfium2
+		except ImportError:
+			self.skipTest('pypdfium2 is not installed')
+		Data = secrets.token_bytes(3000)
+		self.assertEqual(Decoder(Retries = ()).Decode(Encoder(ColNum = 4, RowNum = 4).Encode(Data)), Data)
+
+class TestDemultiplexAndDecode(unittest.TestCase):
+
+	def test_DemultiplexAndDecode_mixed(self):
+		Data = [ secrets.token_bytes(1000), secrets.token_bytes(2000) ]
+		Datasets = [ CreateDataset(Data[0], BlockFormat = 1), CreateDataset(Data[1]) ]
+		Codes = [ [ Code.decode('ascii') for Code in Dataset['Codes'] ] for Dataset in Datasets ]
+		# Shuffled stack, plus a piece of a third archive without root block
+		Stack = list(itertools.chain(*itertools.zip_longest(*Codes))) + [ Code.decode('ascii') for Code in CreateDataset(Data[0])['Codes'] ][3:5]
+		Result = DemultiplexAndDecode([ Code for Code in Stack if Code is not None ])
+		self.assertEqual(len(Result), 3)
+		for Dataset, Expected in zip(Datasets, Data): self.assertEqual(Result[Dataset['RunID']['hex']]['Data'], Expected)
+		self.assertEqual([ Run['Error'] for Run in Result.values() ].count('No root block in input data!'), 1)
+
+class TestDecodeSession(unittest.TestCase):
+
+	def test_DecodeSession_resume(self):
+		Data = secrets.token_bytes(5000)
+		Codes = [ Code.decode('ascii') for Code in CreateDataset(Data)['Codes'] ]
+		with tempfile.TemporaryDirectory() as TempDir:
+			with DecodeSession(os.path.join(TempDir, 'session.db')) as Session:
+				self.assertEqual(Session.AddBlocks(Codes[:30] + Codes[:5]), 30)
+				Status = Session.Status()
+				self.assertEqual((Status['Length'], Status['Missing'], Status['Complete']), (len(Codes), list(range(30, len(Codes))), False))
+			# Blocks are kept between sessions
+			with DecodeSession(os.path.join(TempDir, 'session.db')) as Session:
+				self.assertEqual(Session.AddBlocks(Codes[25:]), len(Codes) - 30)
+				self.assertEqual(Session.Finalize(), Data)
+
+class TestServeMain(unittest.TestCase):
+
+	def test_ServeMain_inbox(self):
+		Data = secrets.token_bytes(3000)
+		with tempfile.TemporaryDirectory() as TempDir:
+			os.mkdir(os.path.join(TempDir, 'inbox'))
+			for PageNumber, Page in enumerate(Encoder(ColNum = 4, RowNum = 4).Rasterize(Data)): cv2.imwrite(os.path.join(TempDir, 'inbox', f'page-{PageNumber + 1}.png'), Page)
+			Events = io.StringIO()
+			asyncio.run(ServeMain(os.path.join(TempDir, 'inbox'), os.path.join(TempDir, 'output'), Once = True, Retries = (), EventStream = Events))
+			Events = [ json.loads(Line) for Line in Events.getvalue().splitlines() ]
+			self.assertEqual([ Event['Event'] for Event in Events ], ['Image', 'Status', 'Image', 'Archive'])
+			with open(Events[-1]['Path'], 'rb') as Output: self.assertEqual(Output.read(), Data)
+
+	def test_ServeMain_metrics(self):
+		# Pages decoded by the pool are counted here
+		Page = cv2.imencode('.png', next(Encoder(ColNum = 4, RowNum = 4).Rasterize(b'pawpyrus')))[1].tobytes()
+		Requests = io.StringIO(json.dumps({ 'Data': base64.b64encode(Page).decode('ascii'), 'Name': 'page' }) + '\n')
+		Events = io.StringIO()
+		ResetMetrics()
+		with tempfile.TemporaryDirectory() as TempDir:
+			asyncio.run(ServeMain(None, TempDir, Jobs = 2, Retries = (), RequestStream = Requests, EventStream = Events))
+		Report = MetricsReport()
+		self.assertEqual(Report['Counters']['decode.pages'], 1)
+		self.assertEqual(Report['Counters']['decode.cells'], json.loads(Events.getvalue().splitlines()[0])['Cells'])
+		self.assertIn('decode.qr.pyzbar', Report['Timers'])
+
+	def test_ServeMain_duplicates(self):
+		# The same image sent twice at once is decoded once
+		Page = cv2.imencode('.png', next(Encoder(ColNum = 4, RowNum = 4).Rasterize(b'pawpyrus')))[1].tobytes()
+		Requests = io.StringIO(json.dumps({ 'Data': base64.b64encode(Page).decode('ascii'), 'Name': 'page' }) + '\n' + json.dumps({ 'Data': base64.b64encode(Page).decode('ascii'), 'Name': 'copy' }) + '\n')
+		Events = io.StringIO()
+		with tempfile.TemporaryDirectory() as TempDir:
+			asyncio.run(ServeMain(None, TempDir, Jobs = 2, Retries = (), RequestStream = Requests, EventStream = Events))
+		self.assertEqual(sorted(json.loads(Line)['Event'] for Line in Events.getvalue().splitlines()), ['Archive', 'Image', 'Skipped'])
+
+	def test_ServeMain_errors(self):
+		# Bad requests are reported, the service goes on and stops at the end of input
+		Requests = io.StringIO('\n'.join([ '{"Path": 123}', '{"Data": "!"}', '{"Data": "cGF3cHlydXM="}', '{"Path": "missing.png"}', 'pawpyrus', '{}' ]) + '\n')
+		Events = io.StringIO()
+		with tempfile.TemporaryDirectory() as TempDir:
+			asyncio.run(ServeMain(None, TempDir, Jobs = 1, Retries = (), RequestStream = Requests, EventStream = Events))
+		self.assertEqual([ json.loads(Line)['Event'] for Line in Events.getvalue().splitlines() ], ['Error'] * 6)
+
+class TestBenchmarkMain(unittest.TestCase):
+
+	def test_BenchmarkMain_small(self):
+		Report = BenchmarkMain(Sizes = (2000,), Profiles = ('clean', 'scan'), ColNum = 4, RowNum = 4)
+		self.assertEqual(Report['SuccessRate'], 1.0)
+		self.assertEqual(set(Report['Runs'][0]['Encode'].keys()), {'CreateDataset', 'CreatePixelSheets', 'DrawSVG', 'CreatePDF', 'RasterizePage'})
+		self.assertEqual(Report['Runs'][0]['Decode']['scan']['Recognized'], Report['Runs'][0]['Decode']['scan']['Total'])
+
+class TestMetrics(unittest.TestCase):
+
+	def test_Metrics_hook(self):
+		Observed = list()
+		def Hook(Kind, Name, Value): Observed.append((Kind, Name))
+		ResetMetrics()
+		AddMetricsHook(Hook)
+		try:
+			Data = secrets.token_bytes(1000)
+			Pages = list(Encoder(ColNum = 4, RowNum = 4).Rasterize(Data))
+			Decoder(Retries = ()).Decode(Pages)
+		finally:
+			RemoveMetricsHook(Hook)
+		Report = MetricsReport()
+		self.assertEqual(Report['Counters']['decode.pages'], 1)
+		self.assertEqual(Report['Counters']['decode.cells_recognized.binary'], Report['Counters']['encode.blocks'])
+		self.assertEqual(Report['Timers']['decode.markers']['Count'], 1)
+		self.assertIn(('timer', 'decode.verify'), Observed)
+
+class TestBase64Stream(unittest.TestCase):
+
+	def test_Base64Stream_normal(self):
+		# Pieces hold whole chunks, except the last one
+		RawData = bytes(range(256)) * 7
+		Pieces = list(Base64Stream(io.BytesIO(RawData), ChunkSize = 108, BufferSize = 5))
+		self.assertEqual(b''.join(Pieces), base64.b64encode(RawData))
+		self.assertTrue(all(len(Piece) % 108 == 0 for Piece in Pieces[:-1]))
+
+class TestCreateBlocks(unittest.TestCase):
+
+	def test_CreateBlocks_normal(self):
+		# Framed in batches, across read buffers, as base64 of 24-bit Run ID and block number
+		RawData = secrets.token_bytes(READ_BUFFER_SIZE * 2 + 1000)
+		Blocks = list(CreateBlocks(io.BytesIO(RawData), b'HEADER', 0xABCDEF, ChunkSize = 100))
+		Chunks = [b'HEADER'] + list(sliced(base64.b64encode(RawData), 100))
+		Expected = [ base64.b64encode(((0xABCDEF << 24) | Index).to_bytes(6, 'big')) + Chunk for Index, Chunk in enumerate(Chunks) ]
+		self.assertEqual(Blocks, Expected)
+
+class TestMergeRuns(unittest.TestCase):
+
+	def test_MergeRuns_normal(self):
+		Bitmap = numpy.zeros((2, 6), dtype = bool)
+		for X, Y in [(3, 1), (0, 0), (1, 0), (2, 1), (2, 0), (5, 0)]: Bitmap[Y, X] = True
+		Data = MergeRuns(Bitmap).tolist()
+		Expected = [[0, 0, 3], [5, 0, 1], [2, 1, 2]]
+		self.assertEqual(Data, Expected)
+
+class TestSelfTestMain(unittest.TestCase):
+
+	def test_SelfTestMain_normal(self):
+		Report = SelfTestMain(None, 1000, 6, 8)
+		self.assertTrue(Report['Success'])
+		self.assertEqual(Report['Blocks']['Recognized'], Report['Blocks']['Total'])
+
+class TestFitChunkSize(unittest.TestCase):
+
+	def test_FitChunkSize_normal(self):
+		self.assertEqual(FitChunkSize(10, ERROR_CORRECT_L, BlockFormat = 1), 260)
+		self.assertEqual(FitChunkSize(10, ERROR_CORRECT_H, BlockFormat = 1), 108)
+		self.assertEqual(FitQRVersion(108, ERROR_CORRECT_L, BlockFormat = 1), 6)
+		self.assertEqual(FitChunkSize(6, ERROR_CORRECT_L, BlockFormat = 2), 122)
+		self.assertEqual(FitChunkSize(10, ERROR_CORRECT_L, BlockFormat = 2), 255)
+
+class TestExtractMetadata(unittest.TestCase):
+
+	def test_ExtractMetadata_normal(self):
+		Dataset = CreateDataset(b'pawpyrus', ChunkSize = None, QRVersion = 10, ErrorCorrection = ERROR_CORRECT_M, BlockFormat = 1)
+		Header = ExtractData(next(Dataset['Codes']).decode('ascii'))
+		Data = ExtractMetadata(Header['Content'])
+		Expected = { 'Length': 2, 'Hash': hashlib.sha256(b'pawpyrus').hexdigest(), 'QRVersion': 10, 'ErrorCorrection': ERROR_CORRECT_M, 'ChunkSize': 204, 'Size': None, 'Stripes': 0, 'ParityBlocks': 0, 'Compression': 0 }
+		self.assertEqual(Data, Expected)
+
+	def test_ExtractMetadata_binary(self):
+		Dataset = CreateDataset(b'pawpyrus', ChunkSize = None, QRVersion = 10, ErrorCorrection = ERROR_CORRECT_M, BlockFormat = 2)
+		Header = ExtractData(next(Dataset['Codes']).decode('ascii'))
+		Data = ExtractMetadata(Header['Content'])
+		Expected = { 'Length': 2, 'Hash': hashlib.sha256(b'pawpyrus').hexdigest(), 'QRVersion': 10, 'ErrorCorrection': ERROR_CORRECT_M, 'ChunkSize': 199, 'Size': 8, 'Stripes': 0, 'ParityBlocks': 0, 'Compression': 0 }
+		self.assertEqual(Data, Expected)
+
+class TestBase45Encode(unittest.TestCase):
+
+	def test_Base45Encode_normal(self):
+		# RFC 9285 examples
+		self.assertEqual(Base45Encode(b'Hello!!'), '%69 VD92EX0')
+		self.assertEqual(Base45Decode('QED8WEX0'), b'ietf!')
+		RawData = bytes(range(256)) + bytes(101)
+		self.assertEqual(Base45Decode(Base45Encode(RawData)), RawData)
+
+class TestVerifyAndDecode(unittest.TestCase):
+
+	def test_VerifyAndDecode_binary(self):
+		# Zero runs are scrambled, otherwise python-qrcode fails on all-zero codewords
+		RawData = bytes(1000)
+		Dataset = CreateDataset(RawData)
+		Codes = list(Dataset['Codes'])
+		for Code in Codes: TomcatMatrix(Code, QRVersion = Dataset['QRVersion'])
+		self.assertEqual(VerifyAndDecode([ Code.decode('ascii') for Code in Codes ]), RawData)
+
+	def test_VerifyAndDecode_compressed(self):
+		Text = json.dumps({ f'key-{Index}': f'value {Index}' for Index in range(500) }).encode('ascii')
+		for Compression in ('zlib', 'lzma', 'bz2', 'auto'):
+			Dataset = CreateDataset(Text, Compression = Compression, Parity = 0.1)
+			self.assertLess(Dataset['StoredSize'], len(Text) / 3)
+			self.assertEqual(VerifyAndDecode([ Code.decode('ascii') for Code in Dataset['Codes'] ]), Text)
+		# Random data do not compress, auto mode stores them as is
+		self.assertEqual(CreateDataset(secrets.token_bytes(1000), Compression = 'auto')['Compression'], 'none')
+
+class TestRecoverBlocks(unittest.TestCase):
+
+	def test_RecoverBlocks_normal(self):
+		RawData = secrets.token_bytes(20000)
+		Dataset = CreateDataset(RawData, Parity = 0.2)
+		Codes = [ Code.decode('ascii') for Code in Dataset['Codes'] ]
+		self.assertEqual(len(Codes), Dataset['Total'])
+		# Lost page: root block and 30 data blocks, the last one is shorter
+		self.assertEqual(VerifyAndDecode(Codes[31 : Dataset['Length']['int'] - 1] + Codes[Dataset['Length']['int'] :]), RawData)
+		with self.assertRaises(RuntimeError): VerifyAndDecode(Codes[: 1] + Codes[40 :])
+
+	def test_RecoverBlocks_stripes(self):
+		# Several stripes, the last ones shorter by a block
+		ChunkSize = CreateDataset(b'pawpyrus')['ChunkSize']
+		for DataNum in (247, 249, 461):
+			RawData = secrets.token_bytes((ChunkSize * (DataNum - 1)) + 5)
+			Dataset = CreateDataset(RawData, Parity = 0.1)
+			self.assertGreater(Dataset['Parity']['Stripes'], 1)
+			Codes = [ Code.decode('ascii') for Code in Dataset['Codes'] ]
+			self.assertEqual(VerifyAndDecode(Codes[: 2] + Codes[3 :]), RawData)